@@ -0,0 +1,142 @@
+import struct
+import numpy as np
+import cv2
+
+# grayscale reader for the uncompressed BMPs the rigs write
+#
+# The pixel rows are memory-mapped instead of decoded into a new buffer. An
+# 8-bit file with a gray palette is returned as a view of the mapping with no
+# copy at all, and a 24-bit file is converted to gray straight from the
+# mapping. Anything else (other bit depths, compression, other formats) is
+# read with cv2.imread. Mappings are copy-on-write, so writing into an image
+# never touches the file.
+#
+# OpenCV's BMP decoder weights the first byte of each pixel (blue) by 0.299
+# when reading grayscale, which is what cvtColor's RGB2GRAY does to BGR data.
+# The two round the same way in OpenCV 3 but not in every version, so the
+# 24-bit path is only used when a probe image decodes identically both ways;
+# otherwise 24-bit files go through cv2.imread too.
+
+FILE_HEADER = struct.Struct("<2sIHHI")
+INFO_HEADER = struct.Struct("<IiiHHI")
+
+# BITMAPINFOHEADER and its V4/V5 extensions, which share its first fields
+INFO_HEADER_SIZES = (40, 52, 56, 108, 124)
+
+BI_RGB = 0
+
+# whether cvtColor reproduces the decoder's grayscale conversion (see above)
+decoder_gray_matches = None
+
+def check_decoder_gray():
+
+    global decoder_gray_matches
+
+    if decoder_gray_matches is None:
+        rng = np.random.RandomState(0)
+        probe = rng.randint(0, 256, (256, 256, 3)).astype(np.uint8)
+        _, buf = cv2.imencode(".bmp", probe)
+        decoded = cv2.imdecode(buf, cv2.IMREAD_GRAYSCALE)
+        decoder_gray_matches = np.array_equal(decoded, cv2.cvtColor(probe, cv2.COLOR_RGB2GRAY))
+
+    return decoder_gray_matches
+
+def bmp_layout(filepath):
+
+    # returns (pixel offset, width, height, bits per pixel, top down, palette
+    # as an (n, 3) BGR array or None) for an uncompressed 8- or 24-bit BMP,
+    # or None if the file is anything else
+
+    with open(filepath, "rb") as f:
+        header = f.read(FILE_HEADER.size + INFO_HEADER.size)
+
+        if len(header) < FILE_HEADER.size + INFO_HEADER.size:
+            return
+
+        magic, _, _, _, offset = FILE_HEADER.unpack_from(header)
+        info_size, width, height, _, bpp, compression = INFO_HEADER.unpack_from(header, FILE_HEADER.size)
+
+        if (magic != "BM") or (info_size not in INFO_HEADER_SIZES) or (compression != BI_RGB) or (bpp not in (8, 24)) or (width <= 0) or (height == 0):
+            return
+
+        palette = None
+        if bpp == 8:
+            f.seek(FILE_HEADER.size + info_size)
+            entries = np.fromfile(f, dtype=np.uint8, count=4*256)
+            n = min(256, (offset - FILE_HEADER.size - info_size)//4, len(entries)//4)
+            palette = entries[0:4*n].reshape(n, 4)[:,0:3]
+
+    return offset, width, abs(height), bpp, height < 0, palette
+
+def read_bmp(filepath):
+
+    # returns the image as a 2D uint8 array, or None if the file isn't an
+    # uncompressed 8- or 24-bit BMP or needs a grayscale conversion that
+    # wouldn't match cv2.imread's (see check_decoder_gray)
+
+    try:
+        layout = bmp_layout(filepath)
+    except (IOError, struct.error):
+        return
+
+    if layout is None:
+        return
+
+    offset, width, height, bpp, top_down, palette = layout
+
+    # only an 8-bit gray ramp skips the grayscale conversion
+    levels = np.arange(256)[:,np.newaxis]
+    gray_ramp = (bpp == 8) and (len(palette) == 256) and np.all(palette == levels)
+
+    if not (gray_ramp or check_decoder_gray()):
+        return
+
+    stride = ((bpp*width + 31)//32)*4
+
+    try:
+        rows = np.memmap(filepath, dtype=np.uint8, mode="c", offset=offset, shape=(height, stride))
+    except (IOError, ValueError):
+        # truncated file
+        return
+
+    if bpp == 24:
+        im = cv2.cvtColor(rows[:, 0:3*width].reshape(height, width, 3), cv2.COLOR_RGB2GRAY)
+        if not top_down:
+            im = im[::-1]
+        return im
+
+    im = rows[:, 0:width]
+    if not top_down:
+        im = im[::-1]
+
+    if gray_ramp:
+        return im
+
+    gray = cv2.cvtColor(np.ascontiguousarray(palette).reshape(1, len(palette), 3), cv2.COLOR_RGB2GRAY).ravel()
+    lut = np.zeros(256, dtype=np.uint8)
+    lut[0:len(gray)] = gray
+    return lut[im]
+
+def imread_grayscale(filepath):
+
+    # drop-in for cv2.imread(filepath, cv2.IMREAD_GRAYSCALE)
+
+    im = None
+    if filepath.lower().endswith(".bmp"):
+        im = read_bmp(filepath)
+
+    if im is None:
+        im = cv2.imread(filepath, cv2.IMREAD_GRAYSCALE)
+
+    return im
+
+def load_pages(im):
+
+    # reads every page under a memory-mapped image (rows are touched every
+    # 2048 bytes, less than a page), so that the first pass over it doesn't
+    # wait on the disk
+
+    if isinstance(im, np.memmap):
+        np.sum(im[:, ::2048], dtype=np.uint64)
+
+    return im
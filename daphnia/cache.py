@@ -0,0 +1,59 @@
+import hashlib
+from clone import PARAMETERS, PARAMETER_DEFAULTS
+from utils import PickleStore
+
+# bump when a change to the analysis makes existing cache entries stale
+CACHE_VERSION = "5"
+
+def file_digest(path):
+
+    # SHA-1 of a file's contents
+
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+def effective_params(params_dict):
+
+    # the parameter values a Clone actually runs with
+
+    return tuple([(k, params_dict.get(k, PARAMETER_DEFAULTS.get(k))) for k in PARAMETERS])
+
+class ResultCache(PickleStore):
+
+    # on-disk cache of CloneResult records keyed on a hash of the image bytes
+    # and the effective parameters, shared by worker processes
+
+    def key(self, image_filepath, params_dict, image_digest=None):
+
+        # image_digest is file_digest(image_filepath), if already computed
+        if image_digest is None:
+            image_digest = file_digest(image_filepath)
+
+        h = hashlib.sha1()
+        h.update(CACHE_VERSION)
+        h.update(repr(effective_params(params_dict)))
+        h.update(image_digest)
+
+        return h.hexdigest()
+
+    def get(self, key, image_filepath):
+
+        # returns the cached result for key, or None
+
+        result = self.load(key)
+        if result is None:
+            return None
+
+        # identical images can live under different names
+        result.filepath = image_filepath
+        result.filebase = image_filepath.split("/")[-1]
+
+        return result
+
+    def put(self, key, result):
+
+        self.save(key, result)
@@ -6,8 +6,150 @@ import cv2
 import scipy
 from scipy.ndimage import map_coordinates as mc
 from skimage import measure
-from skimage.filters import gaussian
-import random
+from collections import defaultdict
+from preprocess import Preprocessor, EdgeIndex
+
+# tuning parameters read from params.txt
+PARAMETERS = ("count_animal_pixels_blur",
+        "count_animal_pixels_n",
+        "count_animal_pixels_cc_threshold",
+        "canny_minval",
+        "canny_maxval",
+        "find_eye_blur",
+        "find_eye_max_retries",
+        "mask_antenna_blur",
+        "edge_pixel_distance_threshold_multiplier",
+        "mask_antenna_coronal_tilt",
+        "mask_antenna_anterior_tilt",
+        "mask_antenna_posterior_tilt",
+        "fit_ellipse_chi2",
+        "find_head_blur",
+        "find_tail_blur",
+        "dorsal_edge_blur",
+        "analyze_pedestal_moving_avg_window",
+        "analyze_pedestal_percentile",
+        "analyze_pedestal_polyfit_degree",
+        "pedestal_n",
+        "traverse_max_iter",
+        "pyramid_scale",
+        "roi_padding")
+
+# defaults for the parameters that params.txt may leave out
+PARAMETER_DEFAULTS = {"find_eye_max_retries": 20,
+        "traverse_max_iter": None,
+        "pyramid_scale": 1,
+        "roi_padding": None}
+
+# blur sigmas, which are divided by pyramid_scale for the downsampled image
+BLUR_PARAMETERS = ("count_animal_pixels_blur",
+        "find_eye_blur",
+        "mask_antenna_blur",
+        "find_head_blur",
+        "find_tail_blur",
+        "dorsal_edge_blur")
+
+# parameters the analysis may change for a particular image (find_eye adds
+# blur when it retries); every other parameter keeps its params.txt value
+ADJUSTED_PARAMETERS = ("find_eye_blur",)
+
+# everything reported for an analyzed clone, without the parameters and the
+# image-sized intermediates (edges, edge_copy, preprocessor, eye_pts,
+# whole_animal_points). Adjusted parameters are kept with the values the
+# analysis ended up using.
+RESULT_FIELDS = ("filepath",
+        "filebase",
+        "animal_area",
+        "animal_dorsal_area",
+        "eye_area",
+        "animal_length",
+        "pedestal",
+        "binned_pedestal_data",
+        "pedestal_area",
+        "pedestal_max_height",
+        "pedestal_window_max_height",
+        "pedestal_window_area",
+        "pedestal_theta",
+        "animal_x_center",
+        "animal_y_center",
+        "animal_major",
+        "animal_minor",
+        "animal_theta",
+        "eye_x_center",
+        "eye_y_center",
+        "eye_major",
+        "eye_minor",
+        "eye_theta",
+        "anterior",
+        "posterior",
+        "dorsal",
+        "ventral",
+        "flip",
+        "ant_vec",
+        "pos_vec",
+        "dor_vec",
+        "ven_vec",
+        "ventral_mask_endpoints",
+        "dorsal_mask_endpoints",
+        "anterior_mask_endpoints",
+        "eye_dorsal",
+        "eye_ventral",
+        "head",
+        "tail",
+        "tail_dorsal",
+        "tail_base",
+        "tail_tip",
+        "tail_spine_length",
+        "dorsal_point",
+        "dorsal_edge",
+        "checkpoints",
+        "qi",
+        "q",
+        "peak",
+        "deyecenter_pedestalmax",
+        "poly_coeff",
+        "res",
+        "dorsal_residual",
+        "automated_PF",
+        "automated_PF_reason",
+        "analyzed",
+        "failed",
+        "accepted",
+        "modified",
+        "modification_notes",
+        "modifier") + ADJUSTED_PARAMETERS
+
+class CloneResult(object):
+
+    # compact record of an analyzed clone
+    #
+    # Only RESULT_FIELDS are kept, in slots, so this is what gets sent from
+    # worker processes to the writer. Parameters that aren't adjusted per
+    # image stay in the shared params_dict rather than being copied onto
+    # every record.
+
+    __slots__ = RESULT_FIELDS
+
+    def __init__(self, **fields):
+
+        for f in RESULT_FIELDS:
+            setattr(self, f, fields.get(f, np.nan))
+
+    @classmethod
+    def from_clone(cls, clone):
+
+        result = cls.__new__(cls)
+        for f in RESULT_FIELDS:
+            setattr(result, f, getattr(clone, f, np.nan))
+        return result
+
+    def __getstate__(self):
+
+        return tuple([getattr(self, f) for f in RESULT_FIELDS])
+
+    def __setstate__(self, state):
+
+        for f, val in zip(RESULT_FIELDS, state):
+            setattr(self, f, val)
 
 class Clone(object):
     
@@ -88,6 +230,9 @@ class Clone(object):
         self.automated_PF_reason = ''
 
         self.analyzed = False
+
+        # set when a stage raised, so that the result isn't cached
+        self.failed = False
         self.accepted = 0
         self.modified = 0
         self.modification_notes = ""
@@ -102,6 +247,7 @@ class Clone(object):
         self.canny_maxval = kwargs['canny_maxval']
 
         self.find_eye_blur = kwargs['find_eye_blur']
+        self.find_eye_max_retries = kwargs.get('find_eye_max_retries', PARAMETER_DEFAULTS['find_eye_max_retries'])
     
         self.mask_antenna_blur = kwargs['mask_antenna_blur']
         self.edge_pixel_distance_threshold_multiplier = kwargs['edge_pixel_distance_threshold_multiplier']
@@ -121,6 +267,40 @@ class Clone(object):
         self.analyze_pedestal_percentile = kwargs['analyze_pedestal_percentile']
         self.analyze_pedestal_polyfit_degree = kwargs['analyze_pedestal_polyfit_degree']
         self.pedestal_n = kwargs['pedestal_n']
+        self.traverse_max_iter = kwargs.get('traverse_max_iter', PARAMETER_DEFAULTS['traverse_max_iter'])
+
+        # with pyramid_scale > 1, the eye and features are found on the image
+        # downsampled by that factor and refined at full resolution; find_head
+        # and the later stages always run at full resolution. At scale 2 the
+        # landmarks on the test and synthetic images match the full-resolution
+        # search and dorsal_residual is within 0.5% (tests/test_pyramid.py).
+        self.pyramid_scale = int(kwargs.get('pyramid_scale', PARAMETER_DEFAULTS['pyramid_scale']))
+        self.coarse = None
+
+        # with roi_padding set, the stages after find_features only look at
+        # the animal's bounding box padded by that many pixels; roi is
+        # (x0, x1, y0, y1) and every stored point stays in full-image space
+        self.roi_padding = kwargs.get('roi_padding', PARAMETER_DEFAULTS['roi_padding'])
+        self.roi = None
+
+        # shared CLAHE/blur/edge cache for the image being analyzed
+        self.preprocessor = None
+
+        # work counters (find_eye retries, edge traversal steps and window growths)
+        self.counters = defaultdict(int)
+
+    def __getstate__(self):
+
+        # leave the image-sized intermediates out of pickles
+        state = self.__dict__.copy()
+        state['preprocessor'] = None
+        state['edges'] = None
+        state['edge_copy'] = None
+        return state
+
+    def result(self):
+
+        return CloneResult.from_clone(self)
 
     def dist(self,x,y):
 
@@ -173,81 +353,111 @@ class Clone(object):
 
     def find_eye(self, im):
 
-        hc = self.high_contrast(im)
-        edges = cv2.Canny(np.array(255*gaussian(hc, self.find_eye_blur), dtype=np.uint8),self.canny_minval,self.canny_maxval)/255
+        # a new analysis starts on the whole image
+        self.roi = None
+
+        if (self.pyramid_scale > 1) and self.find_eye_pyramid(im):
+            return
 
         # initialize eye center
         eye_im = np.where((im < np.percentile(im, 0.025)))
         ex, ey = np.median(eye_im, axis=1)
+        seed = (int(ex), int(ey))
 
-        to_check = [(int(ex), int(ey))]
-        checked = []
-        eye = []
-
-        count = 0
-
-        while len(to_check)>0:
-            pt = to_check[0]
-            if (edges[pt[0]-1, pt[1]] == 0) and (edges[pt[0]+1, pt[1]] == 0) and (edges[pt[0], pt[1]-1] == 0) and (edges[pt[0], pt[1]+1] == 0):
-                count +=1
-                eye.append((pt[0], pt[1]))
-                if ((pt[0]-1, pt[1]) not in checked) and ((pt[0]-1, pt[1]) not in to_check):
-                        to_check.append((pt[0]-1, pt[1]))
-                if ((pt[0]+1, pt[1]) not in checked) and ((pt[0]+1, pt[1]) not in to_check):
-                        to_check.append((pt[0]+1, pt[1]))
-                if ((pt[0], pt[1]-1) not in checked) and ((pt[0], pt[1]-1) not in to_check):
-                        to_check.append((pt[0], pt[1]-1))
-                if ((pt[0], pt[1]+1) not in checked) and ((pt[0], pt[1]+1) not in to_check):
-                        to_check.append((pt[0], pt[1]+1))
-            
-            checked.append(to_check.pop(0))
-        
+        eye = self.flood_fill(self.edge_image(im, self.find_eye_blur), seed)
+        retries = 0
+
+        # if no eye is found, retry with more blur (edge maps for each blur are cached)
+        while (len(eye) == 0) and (retries < self.find_eye_max_retries):
+            self.find_eye_blur += 0.25
+            retries += 1
+            self.counters['find_eye_retries'] += 1
+            eye = self.flood_fill(self.edge_image(im, self.find_eye_blur), seed)
+
+        self.eye_pts = eye
+
+        if len(eye) == 0:
+            print "Could not find eye after " + str(retries) + " retries"
+            return
+
+        self.eye_x_center, self.eye_y_center = np.mean(eye, axis=0)
+        self.eye_area = len(eye)
+
+    def find_eye_pyramid(self, im):
+
+        # finds the eye on the downsampled image, then flood fills it again at
+        # full resolution in a window around it. Returns False, so that the
+        # full-resolution search runs, if the eye isn't found on the
+        # downsampled image or the refined eye runs into the window border.
+
+        self.coarse = self.coarse_clone()
 
-        self.eye_pts = np.array(eye)
         try:
-            self.eye_x_center, self.eye_y_center = np.mean(np.array(eye), axis=0)
-            self.eye_area = count
-        except (TypeError, IndexError):
-            self.find_eye_blur+=0.25
-            self.find_eye(im)
-        
+            self.coarse.find_eye(self.coarse_image(im))
+        except ValueError:
+            # no pixels darker than the seed percentile on the small image
+            self.coarse.eye_pts = []
 
-    def count_animal_pixels(self, im):
-        
-        hc = self.high_contrast(im)
-        edges = cv2.Canny(np.array(255*gaussian(hc, self.count_animal_pixels_blur), dtype=np.uint8),self.canny_minval,self.canny_maxval)/255
+        if len(self.coarse.eye_pts) == 0:
+            self.coarse = None
+            return False
 
-        cx, cy = self.animal_x_center, self.animal_y_center
+        h, w = im.shape
+        pad = 2*self.pyramid_radius()
+        x0, y0 = np.floor(self.from_coarse(np.min(self.coarse.eye_pts, axis=0)) - pad).astype(int)
+        x1, y1 = np.ceil(self.from_coarse(np.max(self.coarse.eye_pts, axis=0)) + pad).astype(int)
+        x0, y0, x1, y1 = max(0, x0), max(0, y0), min(h, x1 + 1), min(w, y1 + 1)
 
-        hx1, hy1 = self.ventral_mask_endpoints[0]
-        vx, vy = self.ventral_mask_endpoints[1]
-        
-        hx2, hy2 = self.dorsal_mask_endpoints[0]
-        dx, dy = self.dorsal_mask_endpoints[1]
+        edges = self.preprocess(im).edges_window(self.find_eye_blur, self.canny_minval, self.canny_maxval, x0, x1, y0, y1)
+        sx, sy = self.from_coarse((self.coarse.eye_x_center, self.coarse.eye_y_center))
+        eye = self.flood_fill(edges, (int(sx) - x0, int(sy) - y0))
 
-        topx1, topy1 = self.anterior_mask_endpoints[0]
-        topx2, topy2 = self.anterior_mask_endpoints[1]
+        if len(eye) == 0:
+            return False
 
-        maskx = []
-        masky = []
+        # flood_fill treats the window border as edge, so an eye that leaks
+        # past it stops one pixel short (the image border is a real border)
+        lo, hi = np.min(eye, axis=0), np.max(eye, axis=0)
+        if ((x0 > 0) and (lo[0] <= 1)) or ((y0 > 0) and (lo[1] <= 1)) or ((x1 < h) and (hi[0] >= x1 - x0 - 2)) or ((y1 < w) and (hi[1] >= y1 - y0 - 2)):
+            return False
+
+        eye += (x0, y0)
+        self.eye_pts = eye
+        self.eye_x_center, self.eye_y_center = np.mean(eye, axis=0)
+        self.eye_area = len(eye)
+        return True
+
+    def flood_fill(self, edges, seed):
+
+        # returns the 4-connected region grown from seed over pixels whose four
+        # neighbours are all non-edge pixels (the image border counts as edge)
 
-        idxx, idxy = np.where(edges)
+        e = np.pad(edges != 0, 1, mode='constant', constant_values=True)
+        interior = ~(e[:-2, 1:-1] | e[2:, 1:-1] | e[1:-1, :-2] | e[1:-1, 2:])
 
-        for i in np.arange(len(idxx)):
-            if self.intersect([cx, cy, idxx[i], idxy[i]], [hx1, hy1, vx, vy]):
-                maskx.append(idxx[i])
-                masky.append(idxy[i])
+        if not interior[seed]:
+            return np.empty((0, 2), dtype=int)
 
-            if self.intersect([cx, cy, idxx[i], idxy[i]], [hx2, hy2, dx, dy]):
-                maskx.append(idxx[i])
-                masky.append(idxy[i])
+        region = interior.astype(np.uint8)
+        _, _, _, rect = cv2.floodFill(region, None, (seed[1], seed[0]), 2, flags=4)
+        x, y, w, h = rect
 
-            if self.intersect([cx, cy, idxx[i], idxy[i]], [topx1, topy1, topx2,topy2]):
-                maskx.append(idxx[i])
-                masky.append(idxy[i])
+        # only scan the bounding box of the filled region
+        idxx, idxy = np.where(region[y:y+h, x:x+w] == 2)
+        return np.transpose(np.vstack([idxx + y, idxy + x]))
+
+    def count_animal_pixels(self, im):
         
-        edges[[maskx, masky]] = 0
-        idxx, idxy = np.where(edges)
+        edges = self.preprocess(im).edges(self.count_animal_pixels_blur, self.canny_minval, self.canny_maxval).copy()
+
+        cx, cy = self.animal_x_center, self.animal_y_center
+
+        edges = self.mask_antenna(edges, (cx, cy),
+                ventral=self.ventral_mask_endpoints,
+                dorsal=self.dorsal_mask_endpoints,
+                anterior=self.anterior_mask_endpoints)
+
+        edge_index = EdgeIndex(edges)
 
         r = 2*self.dist((cx, cy), self.anterior)
         s = np.linspace(0, 2*np.pi, self.count_animal_pixels_n)
@@ -265,9 +475,7 @@ class Clone(object):
             m = (p2[1] - p1[1])/(p2[0] - p1[0])
             b = p1[1] - m*p1[0]
 
-            diff = np.power(idxy - (m*idxx + b), 2)
-            near_line_idx = np.where(diff < np.percentile(diff, 2))
-            near_line = np.transpose(np.vstack([idxx[near_line_idx], idxy[near_line_idx]]))
+            near_line = edge_index.near_line(m, b)
 
             try:
                 j = np.argmin(np.linalg.norm(near_line-p2, axis=1))
@@ -313,11 +521,13 @@ class Clone(object):
 
     def find_features(self, im):
 
-        ex, ey = self.eye_x_center, self.eye_y_center
+        if self.coarse is not None:
+            self.find_features_pyramid(im)
+            return
 
-        hc = self.high_contrast(im)
+        ex, ey = self.eye_x_center, self.eye_y_center
 
-        edge_image = cv2.Canny(np.array(255*gaussian(hc, self.mask_antenna_blur), dtype=np.uint8),self.canny_minval,self.canny_maxval)/255
+        edge_image = self.edge_image(im, self.mask_antenna_blur)
         edge_copy = edge_image.copy()
 
         edge_index = np.transpose(np.where(edge_image))
@@ -384,6 +594,39 @@ class Clone(object):
         
         self.edge_copy = edge_copy
 
+    def find_features_pyramid(self, im):
+
+        # runs find_features on the downsampled image and maps the results
+        # up. The tail tip is refined with the same criterion among the
+        # full-resolution edge pixels around it.
+
+        coarse = self.coarse
+        coarse.find_features(self.coarse_image(im))
+
+        self.animal_x_center, self.animal_y_center = self.from_coarse((coarse.animal_x_center, coarse.animal_y_center))
+        self.animal_major = self.pyramid_scale*coarse.animal_major
+        self.animal_minor = self.pyramid_scale*coarse.animal_minor
+        self.animal_theta = coarse.animal_theta
+        self.flip = coarse.flip
+
+        for attr in ("anterior", "posterior", "dorsal", "ventral", "ventral_mask_endpoints", "dorsal_mask_endpoints", "anterior_mask_endpoints"):
+            setattr(self, attr, self.from_coarse(getattr(coarse, attr)))
+
+        ex, ey = self.eye_x_center, self.eye_y_center
+        cx, cy = self.animal_x_center, self.animal_y_center
+
+        tail_tip = self.from_coarse(coarse.tail_tip)
+        edge_index = self.edge_window(im, self.mask_antenna_blur, tail_tip, self.pyramid_radius())
+        if len(edge_index) > 0:
+            tail_tip = tuple(edge_index[np.argmax(np.dot(edge_index - np.array([cx, cy]), np.array([cx - ex, cy - ey]))), :])
+
+        self.tail_tip = tail_tip
+        self.dorsal_mask_endpoints[2:] = tail_tip
+
+        # only used for display
+        h, w = im.shape
+        self.edge_copy = cv2.resize(coarse.edge_copy, (w, h), interpolation=cv2.INTER_NEAREST)
+
     def flip_dorsal_ventral(self):
         
         tmp = self.ventral
@@ -392,24 +635,28 @@ class Clone(object):
 
     def mask_antenna(self, edge, center, **kwargs):
         
-        cx, cy = center
-
-        edges_x = np.where(edge)[0]
-        edges_y = np.where(edge)[1]
- 
-        #TO DO: Vectorize
-        mask_x = []
-        mask_y = []
-         
-        for i in xrange(len(edges_x)):
-            for key, value in kwargs.iteritems():
-                try:
-                    if self.intersect([cx, cy, edges_x[i], edges_y[i]], [value[0], value[1], value[2], value[3]]):
-                        mask_x.append(edges_x[i])
-                        mask_y.append(edges_y[i])
-                except TypeError:
-                    continue
-        edge[[mask_x, mask_y]] = 0
+        # removes every edge pixel whose ray from center crosses one of the
+        # masking segments passed in as keyword arguments
+
+        segments = []
+        for key, value in kwargs.iteritems():
+            try:
+                segments.append([value[0], value[1], value[2], value[3]])
+            except (TypeError, IndexError):
+                continue
+
+        edges_x, edges_y = np.where(edge)
+
+        if (len(segments) == 0) or (len(edges_x) == 0):
+            return edge
+
+        rays = np.empty((len(edges_x), 4))
+        rays[:,0], rays[:,1] = center
+        rays[:,2] = edges_x
+        rays[:,3] = edges_y
+
+        masked = np.any(self.intersect_all(rays, segments), axis=1)
+        edge[edges_x[masked], edges_y[masked]] = 0
         return edge
 
     def get_anatomical_directions(self, im, flag="animal"):
@@ -465,8 +712,7 @@ class Clone(object):
     def find_head(self, im):
         
         # estimate tail position for now, and a better estimate will be made in get_dorsal_edge
-        hc = self.high_contrast(im)
-        edges = cv2.Canny(np.array(255*gaussian(hc, self.find_head_blur), dtype=np.uint8),self.canny_minval,self.canny_maxval)/255
+        edges = self.edge_points(im, self.find_head_blur)
         tx, ty = self.tail_tip
         target = 3*self.eye_ventral[0] - 2*self.eye_x_center, 3*self.eye_ventral[1] - 2*self.eye_y_center
         ex, ey = 0.5*tx + 0.5*target[0], 0.5*ty + 0.5*target[1]
@@ -500,11 +746,29 @@ class Clone(object):
             self.tail = self.tail_tip
         
         edx, edy = self.eye_dorsal
-
         tx, ty = self.tail
-        m = (ty - edy)/(tx - edx)
-        b = edy - m*edx
+        d = self.dist((edx, edy), (tx, ty))
+
+        p1, p2 = self.head_line()
+        
+        try:
+            hx, hy = self.find_edge2(edges, p2, p1)
+            self.head = hx, hy
+        
+        except TypeError:
+            
+            # if head edge can't be found, just estimate based on dorsal eye point
+            self.head = (edx - (-0.05*d*(edx - tx))/d, edy - (-0.05*d*(edy - ty))/d)
+
+    def head_line(self):
+
+        # the head is looked for along the line from the dorsal eye point
+        # (p2) out past the front of the animal (p1), stopping at the
+        # anterior mask
+
+        edx, edy = self.eye_dorsal
 
+        tx, ty = self.tail
         d = self.dist((edx, edy), (tx, ty))
         cx = edx - (-0.15*d*(edx - tx))/d
         cy = edy - (-0.15*d*(edy - ty))/d
@@ -518,24 +782,16 @@ class Clone(object):
         else:
             p1 = cx, cy
             p2 = edx, edy
-        
-        try:
-            hx, hy = self.find_edge2(edges, p2, p1)
-            self.head = hx, hy
-        
-        except TypeError:
-            
-            # if head edge can't be found, just estimate based on dorsal eye point
-            self.head = (edx - (-0.05*d*(edx - tx))/d, edy - (-0.05*d*(edy - ty))/d)
+
+        return p1, p2
 
     def find_tail(self, im):
 
-        hc = self.high_contrast(im)
-        edges = cv2.Canny(np.array(255*gaussian(hc, self.find_tail_blur), dtype=np.uint8),self.canny_minval,self.canny_maxval)/255
+        edges = self.edge_image(im, self.find_tail_blur)
 
         tx, ty = self.tail_tip
         
-        ventral_edge = self.traverse_ventral_edge(edges, self.tail_tip, self.anterior, np.array(self.tail_tip) - np.array(self.ven_vec))
+        ventral_edge = self.traverse_ventral_edge(edges, self.tail_tip, self.anterior, np.array(self.tail_tip) - np.array(self.ven_vec), origin=self.roi_origin())
         
         dorsal_edge = self.dorsal_edge
 
@@ -566,12 +822,14 @@ class Clone(object):
         cx, cy = self.animal_x_center, self.animal_y_center
 
         if edges is None:
-            hc = self.high_contrast(im) 
-            edges = cv2.Canny(np.array(255*gaussian(hc, dorsal_edge_blur), dtype=np.uint8), 0, 50)/255
+            edges = self.edge_image(im, dorsal_edge_blur, 0, 50)
+            edge_index = self.edge_points(im, dorsal_edge_blur, 0, 50)
             #edges = self.mask_antenna(edges, (cx, cy),
             #        dorsal=self.dorsal_mask_endpoints,
             #        ventral=self.ventral_mask_endpoints,
             #        anterior=self.anterior_mask_endpoints)
+        else:
+            edge_index = EdgeIndex(edges)
         
         self.edges = edges
 
@@ -588,7 +846,7 @@ class Clone(object):
         for i in np.arange(0,1,0.1):
             mp = (1-i)*hx + i*tx_d, (1-i)*hy + i*ty_d
             x,y = self.orth(mp, d, m, flag="dorsal")
-            p2 = self.find_edge2(edges, mp, (x,y))
+            p2 = self.find_edge2(edge_index, mp, (x,y))
             if p2 is not None:
                 checkpoints.append(p2)
                 counter+=1
@@ -630,10 +888,11 @@ class Clone(object):
             dorsal_edge_blur = self.dorsal_edge_blur
 
         cx, cy = self.animal_x_center, self.animal_y_center
+        origin = (0, 0)
         
         if edges is None:
-            hc = self.high_contrast(im) 
-            edges = cv2.Canny(np.array(255*gaussian(hc, dorsal_edge_blur), dtype=np.uint8), 0, 50)/255
+            edges = self.edge_image(im, dorsal_edge_blur, 0, 50)
+            origin = self.roi_origin()
             #edges = self.mask_antenna(edges, (cx, cy),
             #        dorsal=self.dorsal_mask_endpoints,
             #        ventral=self.ventral_mask_endpoints,
@@ -642,7 +901,7 @@ class Clone(object):
         self.prune_checkpoints()
         checkpoints = self.checkpoints
         # for some reason, calling traverse_dorsal_edge in reverse on the head portion works better
-        dorsal_edge = self.traverse_dorsal_edge(edges, np.array(checkpoints[1]), np.array(checkpoints[0]))[::-1]
+        dorsal_edge = self.traverse_dorsal_edge(edges, np.array(checkpoints[1]), np.array(checkpoints[0]), origin=origin)[::-1]
         
         # traverse_dorsal_edge prunes the target checkpoint from the list (so there aren't duplicates in the final list),
         # but since traverse_dorsal_edge is being called in reverse for the head portion, we want to prune the starting
@@ -662,11 +921,11 @@ class Clone(object):
             #if (k>4) and ((err > self.dist(self.head, self.tail)/16) or (err_plus_one > self.dist(self.head, self.tail)/16)):
             #    raise TypeError
             #else:
-            dorsal_edge = np.vstack([dorsal_edge, self.traverse_dorsal_edge(edges, checkpoints[k,:], checkpoints[k+1,:])])
+            dorsal_edge = np.vstack([dorsal_edge, self.traverse_dorsal_edge(edges, checkpoints[k,:], checkpoints[k+1,:], origin=origin)])
             #except TypeError:
             #    continue
         
-        self.dorsal_edge = np.vstack([dorsal_edge, self.traverse_dorsal_edge(edges, self.tail_dorsal, self.tail_tip)])    
+        self.dorsal_edge = np.vstack([dorsal_edge, self.traverse_dorsal_edge(edges, self.tail_dorsal, self.tail_tip, origin=origin)])    
 
     def remove_tail_spine(self):
         self.dorsal_edge = self.dorsal_edge[0:np.argmin(np.linalg.norm(self.dorsal_edge - self.tail_dorsal, axis=1)), :]
@@ -701,9 +960,24 @@ class Clone(object):
         else:
             return x1, y1
 
-    def traverse_ventral_edge(self, edges, current, target, ventral, n=200):
+    def edge_neighbours(self, edges, current, window, origin=(0, 0)):
+
+        # offsets from current to the edge pixels in the window around it
+        # (the window is a view into edges, so growing it doesn't copy the image).
+        # origin is the image position of edges[0, 0] when edges is a crop.
+
+        w,h = edges.shape
+        x, y = current[0] - origin[0], current[1] - origin[1]
+
+        idx = self.index_on_pixels(edges[int(np.max([0, x-window])):int(np.min([w, x+window+1])),
+            int(np.max([0, y-window])):int(np.min([h, y+window+1]))]) - (window,window)
+
+        return idx[~np.all(idx == 0, axis=1)]
+
+    def traverse_ventral_edge(self, edges, current, target, ventral, n=200, origin=(0, 0)):
         
         ventral_edge = [list(current)]
+        visited = set([tuple(current)])
 
         target_vector = np.array(target) - np.array(current)
         target_vector = self.norm_vec(target_vector)
@@ -712,18 +986,16 @@ class Clone(object):
         ventral_vector = self.norm_vec(ventral_vector)
 
         window = 1
-        w,h = edges.shape
 
         for i in np.arange(n):
             
-            idx = self.index_on_pixels(edges[int(np.max([0, current[0]-window])):int(np.min([w, current[0]+window+1])),
-                int(np.max([0, current[1]-window])):int(np.min([h, current[1]+window+1]))]) - (window,window)
-            idx = idx[~np.all(idx == 0, axis=1)]
+            self.counters['traverse_ventral_iterations'] += 1
+            idx = self.edge_neighbours(edges, current, window, origin)
 
             try:
                 nxt = current + idx[np.argmax(np.dot(idx, target_vector) + np.dot(idx, ventral_vector))]
 
-                if (list(nxt) in ventral_edge) or (self.dist(nxt, target) > self.dist(current, target)):
+                if (tuple(nxt) in visited) or (self.dist(nxt, target) > self.dist(current, target)):
                     raise(ValueError)
                 else:
                     current = nxt
@@ -734,19 +1006,25 @@ class Clone(object):
                     ventral_vector = self.norm_vec(ventral_vector)
 
                     ventral_edge.append(list(current))
+                    visited.add(tuple(current))
                     window=1
             except ValueError:
                  window += 1
+                 self.counters['traverse_ventral_window_growths'] += 1
 
         return np.vstack(ventral_edge)
 
-    def traverse_dorsal_edge(self, edges, current,target):
+    def traverse_dorsal_edge(self, edges, current, target, max_iter=None, origin=(0, 0)):
+
+        # max_iter caps the number of steps (successful or not) taken
 
-        idx = self.index_on_pixels(edges)
+        if max_iter is None:
+            max_iter = self.traverse_max_iter
 
         cx, cy = self.animal_x_center, self.animal_y_center
 
         dorsal_edge = [list(current)]
+        visited = set([tuple(current)])
         
         target_vector = np.array(target) - np.array(current)
         target_vector = self.norm_vec(target_vector)
@@ -757,38 +1035,41 @@ class Clone(object):
         nxt_vector = target_vector
 
         window=1
-        w,h = edges.shape
+        iterations = 0
 
-        while (self.dist(current, target) > 2) and (window < 10):
+        while (self.dist(current, target) > 2) and (window < 10) and ((max_iter is None) or (iterations < max_iter)):
 
-            idx = self.index_on_pixels(edges[ int(np.max([0,current[0]-window])):int(np.min([w,current[0]+window+1])),
-                int(np.max([0, current[1]-window])):int(np.min([h,current[1]+window+1]))]) - (window,window)
-            idx = idx[~np.all(idx == 0, axis=1)]
+            iterations += 1
+            self.counters['traverse_dorsal_iterations'] += 1
+            idx = self.edge_neighbours(edges, current, window, origin)
 
             try:
                 
                 nxt = current + idx[np.argmax(np.dot(idx, dorsal_vector) + np.dot(idx, target_vector) + np.dot(idx, nxt_vector))]
 
-                if (list(nxt) in dorsal_edge) or (self.dist(nxt, target) > self.dist(current, target)):
+                if (tuple(nxt) in visited) or (self.dist(nxt, target) > self.dist(current, target)):
                     raise(ValueError)
                 else:
 
                     target_vector = np.array(target) - np.array(current)
                     target_vector = self.norm_vec(target_vector)
 
-		    dorsal_vector = np.array(current) - np.array((cx, cy))
-		    dorsal_vector = self.norm_vec(dorsal_vector)
+                    dorsal_vector = np.array(current) - np.array((cx, cy))
+                    dorsal_vector = self.norm_vec(dorsal_vector)
 
-		    nxt_vector = np.array(nxt) - np.array(current)
-		    nxt_vector = self.norm_vec(nxt_vector)
-		    
-		    current = nxt
-		    dorsal_edge.append(list(current))
-		    window=1
+                    nxt_vector = np.array(nxt) - np.array(current)
+                    nxt_vector = self.norm_vec(nxt_vector)
+                    
+                    current = nxt
+                    dorsal_edge.append(list(current))
+                    visited.add(tuple(current))
+                    window=1
             
             except ValueError:
                 window += 1
-        if (list(target) in dorsal_edge):
+                self.counters['traverse_dorsal_window_growths'] += 1
+
+        if tuple(target) in visited:
             dorsal_edge.remove(list(target))
 
         return dorsal_edge
@@ -841,18 +1122,18 @@ class Clone(object):
 
     def find_edge2(self, edges, p1, p2):
 
-        idxx, idxy = np.where(edges)
+        # edges can be an edge image or an EdgeIndex built from one
+        if not isinstance(edges, EdgeIndex):
+            edges = EdgeIndex(edges)
         
         # if there are no edges in the image (e.g. blur is too high), exit
-        if (len(idxx) == 0) or (len(idxy) == 0):
+        if len(edges) == 0:
             return
 
         m = (p2[1] - p1[1])/(p2[0] - p1[0])
         b = p1[1] - m*p1[0]
 
-        diff = np.power(idxy - (m*idxx + b), 2)
-        near_line_idx = np.where(diff < np.percentile(diff, 2))
-        near_line = np.transpose(np.vstack([idxx[near_line_idx], idxy[near_line_idx]]))
+        near_line = edges.near_line(m, b)
         
         near_line = near_line[np.linalg.norm(near_line - p2, axis=1) - self.dist(p1, p2) < 0]
 
@@ -862,10 +1143,124 @@ class Clone(object):
         except ValueError:
             return
 
+    def preprocess(self, im):
+
+        # returns the preprocessing cache for im, starting a new one when a
+        # different image is passed in
+        if (self.preprocessor is None) or (self.preprocessor.image is not im):
+            self.preprocessor = Preprocessor(im)
+        return self.preprocessor
+
+    def coarse_clone(self):
+
+        # a clone with the same parameters for the downsampled image, with
+        # the blurs scaled down to match
+        params = dict([(p, getattr(self, p)) for p in PARAMETERS])
+        for p in BLUR_PARAMETERS:
+            params[p] = params[p]/self.pyramid_scale
+        params['pyramid_scale'] = 1
+
+        return Clone(self.filepath, **params)
+
+    def coarse_image(self, im):
+
+        return self.preprocess(im).downsampled(self.pyramid_scale)
+
+    def from_coarse(self, p):
+
+        # full-resolution coordinates of a point (or a flat list of
+        # coordinates) in the downsampled image
+        s = self.pyramid_scale
+        full = s*np.asarray(p, dtype=float) + (s - 1)/2
+
+        if isinstance(p, tuple):
+            return tuple(full)
+        if isinstance(p, list):
+            return list(full)
+        return full
+
+    def pyramid_radius(self):
+
+        # how far a point found on the downsampled image can be from its
+        # full-resolution position
+        return 2*self.pyramid_scale + 2
+
+    def edge_window(self, im, blur, center, radius):
+
+        # full-image coordinates of the edge pixels in the square window of
+        # the given radius around center
+        h, w = im.shape
+        x0, y0 = max(0, int(center[0] - radius)), max(0, int(center[1] - radius))
+        x1, y1 = min(h, int(center[0] + radius) + 1), min(w, int(center[1] + radius) + 1)
+
+        edges = self.preprocess(im).edges_window(blur, self.canny_minval, self.canny_maxval, x0, x1, y0, y1)
+        return np.transpose(np.where(edges)) + np.array([x0, y0])
+
+    def region(self, im):
+
+        # the preprocessing cache for the region of interest, or for the
+        # whole image if none has been set
+        preprocessor = self.preprocess(im)
+
+        if self.roi is None:
+            return preprocessor
+        return preprocessor.crop(*self.roi)
+
+    def roi_origin(self):
+
+        if self.roi is None:
+            return (0, 0)
+        return (self.roi[0], self.roi[2])
+
+    def crop_to_animal(self, im):
+
+        # sets the region of interest to the bounding box of the eye, the
+        # tail tip, the ellipse vertices and the mask endpoints, padded by
+        # roi_padding. The whole-image blurs and edge indices aren't used
+        # again and are freed; edge maps are kept, since the region's maps are
+        # cut from them when a later stage uses the same blur.
+
+        if self.roi_padding is None:
+            return
+
+        points = [(self.eye_x_center, self.eye_y_center), self.tail_tip,
+                self.anterior, self.posterior, self.dorsal, self.ventral]
+
+        points = np.array(points, dtype=float)
+        h, w = im.shape
+
+        x0, y0 = np.floor(np.min(points, axis=0) - self.roi_padding).astype(int)
+        x1, y1 = np.ceil(np.max(points, axis=0) + self.roi_padding).astype(int) + 1
+
+        self.roi = (max(0, x0), min(h, x1), max(0, y0), min(w, y1))
+        self.preprocess(im).clear()
+
+    def edge_image(self, im, blur, minval=None, maxval=None):
+
+        # edges of the region of interest (see roi_origin) or the whole image
+
+        if minval is None:
+            minval = self.canny_minval
+        if maxval is None:
+            maxval = self.canny_maxval
+
+        return self.region(im).edges(blur, minval, maxval)
+
+    def edge_points(self, im, blur, minval=None, maxval=None):
+
+        # EdgeIndex of the region of interest (see edge_image), in
+        # full-image coordinates
+
+        if minval is None:
+            minval = self.canny_minval
+        if maxval is None:
+            maxval = self.canny_maxval
+
+        return self.region(im).edge_index(blur, minval, maxval)
+
     def high_contrast(self, im):
         
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-        return clahe.apply(im)
+        return self.preprocess(im).high_contrast()
     
     def area(self, x, y):
 
@@ -900,6 +1295,32 @@ class Clone(object):
 
         return True
 
+    def intersect_all(self, s1, s2):
+
+        # vectorized version of intersect: tests each segment in s1 (n-by-4)
+        # against each segment in s2 (m-by-4) and returns an n-by-m boolean array
+
+        s1 = np.asarray(s1, dtype=float).reshape(-1, 4)
+        s2 = np.asarray(s2, dtype=float).reshape(-1, 4)
+
+        x1, y1, x2, y2 = [s1[:, [i]] for i in xrange(4)]
+        x3, y3, x4, y4 = [s2[:, i] for i in xrange(4)]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            m1 = (y1 - y2)/(x1 - x2)
+            m2 = (y3 - y4)/(x3 - x4)
+
+            b1 = y1 - m1*x1
+            b2 = y3 - m2*x3
+
+            xa = (b2 - b1) / (m1 - m2)
+
+        hit = ~(np.maximum(x1, x2) < np.minimum(x3, x4))
+        hit &= ~(m1 == m2)
+        hit &= ~((xa < np.maximum(np.minimum(x1, x2), np.minimum(x3, x4))) | (xa > np.minimum(np.maximum(x1, x2), np.maximum(x3, x4))))
+
+        return hit
+
     def intersection(self, s1, s2):
 
         # returns the point of intersection for two line segments
@@ -1017,23 +1438,45 @@ class Clone(object):
 
     def interpolate(self, dorsal_edge):
 
+        # densifies the dorsal edge to pedestal_n points, as if the largest gap
+        # between neighbouring points were split at its midpoint one at a time
+        # (ties go to the gap nearest the start of the edge)
+        #
+        # Splitting gap i fully k times gives 2^k pieces of length d_i/2^k, so
+        # each (gap, level) pair adds 2^k points. Taking these longest first
+        # gives the number of full levels per gap, plus a partial level for one
+        # gap, and the new points are then placed in a single pass.
+
         p = dorsal_edge
-        diff = np.linalg.norm(p[1:,:] - p[0:-1,:], axis=1)
-        biggest_gaps = np.where(diff == np.max(diff))[0]
-        
-        while (p.shape[0] < self.pedestal_n) and (len(biggest_gaps) > 0):
- 
-            i = random.choice(biggest_gaps)
-            biggest_gaps[np.where(biggest_gaps==i)[0][0]+1:] += 1
-            biggest_gaps = np.delete(biggest_gaps, np.where(biggest_gaps == i))
+        n_new = self.pedestal_n - p.shape[0]
 
-            new_point = (p[i] + p[i+1])/2
-            p = np.vstack([p[:i+1, :], new_point, p[i+1:,:]])
+        if (n_new <= 0) or (p.shape[0] < 2):
+            return p
 
-            if len(biggest_gaps) == 0:
-                diff = np.linalg.norm(p[1:,:] - p[0:-1,:], axis=1)
-                try:
-                    biggest_gaps = np.where(diff == np.max(diff))[0]
-                except ValueError:
-                    biggest_gaps = []
-        return p
+        d = np.linalg.norm(p[1:,:] - p[0:-1,:], axis=1)
+        n_gaps = len(d)
+        n_levels = int(np.ceil(np.log2(n_new + 1))) + 1
+
+        gap = np.repeat(np.arange(n_gaps), n_levels)
+        level = np.tile(np.arange(n_levels), n_gaps)
+        length = d[gap]/np.power(2.0, level)
+
+        order = np.lexsort((level, gap, -length))
+        added = np.cumsum(np.power(2, level[order]))
+        n_full = np.sum(added <= n_new)
+
+        splits = np.bincount(gap[order[:n_full]], minlength=n_gaps)
+        partial = np.zeros(n_gaps, dtype=int)
+        partial[gap[order[n_full]]] = n_new - (added[n_full-1] if n_full > 0 else 0)
+
+        # each gap is laid out on a grid of 2^(k+1) steps: even steps are the
+        # full splits and odd steps are the midpoints of the partial level
+        grid = np.power(2, splits + 1)
+        gi = np.repeat(np.arange(n_gaps), grid)
+        step = np.arange(len(gi)) - np.repeat(np.cumsum(grid) - grid, grid)
+
+        keep = (step % 2 == 0) | (step < 2*partial[gi])
+        gi, step = gi[keep], step[keep]
+
+        t = (step/grid[gi])[:, np.newaxis]
+        return np.vstack([p[gi] + t*(p[gi+1] - p[gi]), p[-1]])
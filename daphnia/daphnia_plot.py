@@ -1,9 +1,14 @@
 import numpy as np
+import cv2
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+from matplotlib.colors import colorConverter
 import os
 
+# formats the OpenCV renderer can write; anything else is drawn with matplotlib
+RASTER_FORMATS = ("png", "jpg", "jpeg", "bmp", "tif", "tiff")
+
 def plot_eye_mask(clone, eye_mask=0, eye_mask_color="yellow", eye_mask_alpha=0.1, eye_mask_markersize=1,**kwargs):
     
     if eye_mask:
@@ -117,8 +122,18 @@ def plot_dorsal_edge_checkpoints(clone, dorsal_edge_checkpoint_plot=1,
         for pt in clone.checkpoints.values():
             plt.scatter(pt[1], pt[0], color=dorsal_edge_checkpoint_color)
 
+def plot_path(clone, plot_params):
+
+    return os.path.join( plot_params["daphnia_plot_dir"], "_".join([plot_params["daphnia_plot_name"],clone.filebase[:-4]]) + "." + plot_params["daphnia_plot_format"])
+
 def plot(clone, im, plot_params):
 
+    # daphnia_plot_renderer,opencv draws the overlay straight into the image
+    # (see render) rather than through a matplotlib figure
+    if (plot_params.get("daphnia_plot_renderer", "matplotlib") == "opencv") and (plot_params["daphnia_plot_format"].lower() in RASTER_FORMATS):
+        cv2.imwrite(plot_path(clone, plot_params), render(clone, im, plot_params))
+        return
+
     f = plt.figure(figsize=(20,20))
 
     plot_eye_mask(clone, **plot_params) 
@@ -132,8 +147,182 @@ def plot(clone, im, plot_params):
     plt.imshow(im, cmap="gray")
     plt.axis('off')
 
-    plt.savefig( os.path.join( plot_params["daphnia_plot_dir"], "_".join([plot_params["daphnia_plot_name"],clone.filebase[:-4]]) + "." + plot_params["daphnia_plot_format"]),
+    plt.savefig( plot_path(clone, plot_params),
             format=plot_params["daphnia_plot_format"],
             dpi=int(plot_params["daphnia_plot_resolution"]))
 
     plt.close(f)
+
+# OpenCV renderer
+#
+# Draws the same elements as plot, controlled by the same plot_params keys
+# and defaults, into a BGR copy of the image at its own resolution (so
+# daphnia_plot_resolution doesn't apply). Marker sizes and line widths are
+# in image pixels. Each element is one vectorized drawing call.
+
+def bgr(color):
+
+    r, g, b = colorConverter.to_rgb(color)
+    return (int(round(255*b)), int(round(255*g)), int(round(255*r)))
+
+def finite_points(pts):
+
+    # (n, 2) array of the (row, column) points that are set
+    pts = np.array(pts, dtype=float).reshape(-1, 2)
+    return pts[np.all(np.isfinite(pts), axis=1)]
+
+def segment(endpoints):
+
+    # mask endpoints are stored flat as [x1, y1, x2, y2] (older records
+    # nest them as ((x1, y1), (x2, y2)))
+    return np.array(endpoints, dtype=float).reshape(2, 2)
+
+def draw_points(canvas, pts, color, size=1, alpha=1.0):
+
+    # marks the points, grown to discs of the given diameter, and blends
+    # color over them; only the points' bounding box is touched
+
+    pts = np.round(finite_points(pts)).astype(int)
+    h, w = canvas.shape[0:2]
+    pts = pts[(pts[:,0] >= 0) & (pts[:,0] < h) & (pts[:,1] >= 0) & (pts[:,1] < w)]
+
+    if len(pts) == 0:
+        return
+
+    size = max(1, int(round(size)))
+    x0, y0 = np.maximum(np.min(pts, axis=0) - size, 0)
+    x1, y1 = np.minimum(np.max(pts, axis=0) + size + 1, (h, w))
+
+    mask = np.zeros((x1 - x0, y1 - y0), dtype=np.uint8)
+    mask[pts[:,0] - x0, pts[:,1] - y0] = 1
+    if size > 1:
+        mask = cv2.dilate(mask, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (size, size)))
+
+    region = canvas[x0:x1, y0:y1]
+    selected = mask.astype(bool)
+    region[selected] = ((1 - alpha)*region[selected] + alpha*np.array(color, dtype=float)).astype(np.uint8)
+
+def draw_lines(canvas, lines, color, linewidth=1, closed=False):
+
+    # lines is a list of (n, 2) arrays of (row, column) points; cv2 wants
+    # (x, y), i.e. (column, row)
+
+    polylines = []
+    for line in lines:
+        line = finite_points(line)
+        if len(line) > 1:
+            polylines.append(np.round(line[:, ::-1]).astype(np.int32))
+
+    if len(polylines) > 0:
+        cv2.polylines(canvas, polylines, closed, color, max(1, int(round(linewidth))), cv2.LINE_AA)
+
+def draw_eye_mask(canvas, clone, eye_mask=0, eye_mask_color="yellow", eye_mask_alpha=0.1, eye_mask_markersize=1, **kwargs):
+
+    if eye_mask:
+        draw_points(canvas, clone.eye_pts, bgr(eye_mask_color), eye_mask_markersize, eye_mask_alpha)
+
+def draw_antenna_mask(canvas, clone, antenna_mask=0, antenna_mask_color="blue", antenna_mask_linewidth=3, **kwargs):
+
+    if antenna_mask:
+        edge_copy = getattr(clone, "edge_copy", None)
+        if edge_copy is not None:
+            canvas[edge_copy.astype(bool)] = 0
+
+        segments = []
+        for name in ["ventral_mask_endpoints", "dorsal_mask_endpoints", "anterior_mask_endpoints", "posterior_mask_endpoints"]:
+            try:
+                segments.append(segment(getattr(clone, name)))
+            except (AttributeError, TypeError, ValueError):
+                continue
+
+        draw_lines(canvas, segments, bgr(antenna_mask_color), antenna_mask_linewidth)
+
+def draw_landmarks(canvas, clone, landmarks=1,
+        landmark_head=1,
+        landmark_tail=1,
+        landmark_tail_base=1,
+        landmark_tail_tip=1,
+        landmark_animal_center=1,
+        landmark_eye_center=1,
+        landmark_eye_dorsal=1,
+        landmark_color="red",
+        landmark_style="pixel",
+        landmark_size=3, **kwargs):
+
+    if landmarks:
+        pts = []
+
+        for flag, pt in [(landmark_head, clone.head),
+                (landmark_tail, clone.tail),
+                (landmark_tail_base, clone.tail_base),
+                (landmark_tail_tip, clone.tail_tip),
+                (landmark_animal_center, (clone.animal_x_center, clone.animal_y_center)),
+                (landmark_eye_center, (clone.eye_x_center, clone.eye_y_center)),
+                (landmark_eye_dorsal, clone.eye_dorsal)]:
+            if flag:
+                try:
+                    pts.append(np.array(pt, dtype=float).reshape(2))
+                except (TypeError, ValueError):
+                    # landmark wasn't found
+                    continue
+
+        if len(pts) > 0:
+            draw_points(canvas, pts, bgr(landmark_color), landmark_size)
+
+def draw_lengths(canvas, clone, animal_length_plot=1, animal_length_plot_color="black", animal_length_linewidth=2,
+        tail_spine_length_plot=1, tail_spine_length_plot_color="black", tail_spine_length_linewidth=2, **kwargs):
+
+    if animal_length_plot:
+        draw_lines(canvas, [[clone.tail, clone.head]], bgr(animal_length_plot_color), animal_length_linewidth)
+
+    if tail_spine_length_plot:
+        draw_lines(canvas, [[clone.tail_base, clone.tail_tip]], bgr(tail_spine_length_plot_color), tail_spine_length_linewidth)
+
+def draw_animal_perimeter(canvas, clone, animal_perimeter=1, animal_perimeter_style="line", animal_perimeter_color="green", animal_perimeter_linewidth=2, **kwargs):
+
+    pts = getattr(clone, "whole_animal_points", None)
+
+    if animal_perimeter and (pts is not None):
+
+        # whole_animal_points are (column, row)
+        pts = np.array(pts, dtype=float)[:, ::-1]
+
+        if animal_perimeter_style == "line":
+            draw_lines(canvas, [pts], bgr(animal_perimeter_color), animal_perimeter_linewidth, closed=True)
+        elif animal_perimeter_style == "points":
+            draw_points(canvas, pts, bgr(animal_perimeter_color), 3)
+
+def draw_dorsal_edge(canvas, clone, dorsal_edge_plot=1,
+    dorsal_edge_plot_color="blue",
+    dorsal_edge_plot_alpha=1.0,
+    dorsal_edge_plot_marker_size=2, **kwargs):
+
+    if dorsal_edge_plot:
+        draw_points(canvas, clone.dorsal_edge, bgr(dorsal_edge_plot_color), dorsal_edge_plot_marker_size, dorsal_edge_plot_alpha)
+
+def draw_dorsal_edge_checkpoints(canvas, clone, dorsal_edge_checkpoint_plot=1,
+        dorsal_edge_checkpoint_color="black", **kwargs):
+
+    if dorsal_edge_checkpoint_plot:
+        checkpoints = clone.checkpoints
+        if hasattr(checkpoints, "values"):
+            checkpoints = checkpoints.values()
+
+        draw_points(canvas, checkpoints, bgr(dorsal_edge_checkpoint_color), 5)
+
+def render(clone, im, plot_params):
+
+    # returns the overlay as a BGR image; im is left untouched. Like imshow,
+    # the gray levels are stretched to the image's range.
+
+    canvas = cv2.cvtColor(cv2.normalize(np.ascontiguousarray(im), None, 0, 255, cv2.NORM_MINMAX), cv2.COLOR_GRAY2BGR)
+
+    draw_antenna_mask(canvas, clone, **plot_params)
+    draw_eye_mask(canvas, clone, **plot_params)
+    draw_landmarks(canvas, clone, **plot_params)
+    draw_lengths(canvas, clone, **plot_params)
+    draw_animal_perimeter(canvas, clone, **plot_params)
+    draw_dorsal_edge(canvas, clone, **plot_params)
+    draw_dorsal_edge_checkpoints(canvas, clone, **plot_params)
+
+    return canvas
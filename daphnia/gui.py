@@ -9,8 +9,8 @@ from matplotlib.widgets import Button, Slider, TextBox, LassoSelector
 from matplotlib.path import Path
 import numpy as np
 import pandas as pd
-from skimage.filters import gaussian
 from clone import Clone
+from bmp import imread_grayscale
 import warnings
 warnings.filterwarnings("ignore")
 
@@ -65,7 +65,7 @@ class PointFixer:
     def __init__(self, clone, display):
         
         print "Reading image: " + clone.filebase
-        im = cv2.imread(clone.filepath, cv2.IMREAD_GRAYSCALE)
+        im = imread_grayscale(clone.filepath)
 
         if im is None:
             print "Image " + clone.filepath + " not found. Check your image filepath."
@@ -80,9 +80,7 @@ class PointFixer:
         self.edges = False
         self.edge_blur = 1.0
 
-        hc = self.clone.high_contrast(self.original_image)
-        
-        self.original_edge_image = cv2.Canny(np.array(255*gaussian(hc, self.edge_blur), dtype=np.uint8), 0, 50)/255
+        self.original_edge_image = self.clone.edge_image(self.original_image, self.edge_blur, 0, 50)
         self.edge_image = self.original_edge_image.copy()
 
         self.params = {}
@@ -164,7 +162,7 @@ class PointFixer:
         self.clone.find_head(self.original_image)
         self.clone.initialize_dorsal_edge(self.original_image)
         self.clone.fit_dorsal_edge(self.original_image)
-        self.edge_image = self.clone.edges
+        self.edge_image = self.clone.edges.copy()
         self.clone.find_tail(self.original_image)
         self.clone.remove_tail_spine()
         self.de = self.clone.interpolate(self.clone.dorsal_edge)
@@ -426,14 +424,15 @@ class Viewer:
 
     def __init__(self, gui_params, params):
 
-        self.curation_data = utils.load_manual_curation(params['curation_csvpath'])
-        self.males_list = utils.load_male_list(params['male_listpath'])
-        self.induction_dates = utils.load_induction_data(params['induction_csvpath'])
-        self.season_data = utils.load_pond_season_data(params['pond_season_csvpath'])
-        self.early_release = utils.load_release_data(params['early_release_csvpath'])
-        self.late_release = utils.load_release_data(params['late_release_csvpath'])
-        self.duplicate_data = utils.load_duplicate_data(params['duplicate_csvpath'])
-        self.experimenter_data, self.inducer_data = utils.load_experimenter_data(params['experimenter_csvpath'])
+        (self.curation_data,
+                self.males_list,
+                self.induction_dates,
+                self.season_data,
+                self.early_release,
+                self.late_release,
+                self.duplicate_data,
+                self.experimenter_data,
+                self.inducer_data) = utils.load_metadata_sources(params)
         
         self.gui_params = gui_params
         self.params = params
@@ -640,7 +639,7 @@ class Viewer:
         self.obj.clone.initialize_dorsal_edge(self.obj.original_image, dorsal_edge_blur = self.obj.edge_blur)
         self.obj.clone.fit_dorsal_edge(self.obj.original_image, dorsal_edge_blur = self.obj.edge_blur)
         self.obj.de = self.obj.clone.interpolate(self.obj.clone.dorsal_edge)
-        self.obj.edge_image = self.obj.clone.edges
+        self.obj.edge_image = self.obj.clone.edges.copy()
         
         self.mask_all_regions()
 
@@ -821,7 +820,7 @@ class Viewer:
         with open(self.params["output_shape_file"],"wb") as shape_file_out:
         
             # read/write header
-            line = "\t".join(["filebase","i","x","y","qi","q","checkpoint"]) + "\n"
+            line = "\t".join(utils.SHAPE_COLS) + "\n"
             shape_file_out.write(line)
 
             clone = None
@@ -830,13 +829,9 @@ class Viewer:
                 if c.accepted:
                     clone = c
                 if clone is not None:
-                     
-                    for i in np.arange(len(clone.dorsal_edge)):
-                        if len(np.where((clone.checkpoints==clone.dorsal_edge[i,:]).all(axis=1))[0]) > 0:
-                            checkpoint = 1
-                        else:
-                            checkpoint = 0
-                        shape_file_out.write('\t'.join([clone.filebase, str(i), str(clone.dorsal_edge[i, 0]), str(clone.dorsal_edge[i,1]), str(clone.qi[i]), str(clone.q[i]), str(checkpoint)]) + "\n")
+                    rows = utils.shape_rows(clone)
+                    if len(rows) > 0:
+                        shape_file_out.write("\n".join(rows) + "\n")
                 
                 clone = None
 
@@ -0,0 +1,69 @@
+import sys
+import threading
+import Queue
+from bmp import imread_grayscale, load_pages
+
+def read_image(filepath):
+
+    # the image's pixels, or None if it can't be read, for the caller to
+    # handle as it would a failed read
+
+    try:
+        return load_pages(imread_grayscale(filepath))
+    except Exception:
+        return None
+
+class ImagePrefetcher(object):
+
+    # does the read-ahead for each image on a background thread while
+    # earlier images are analyzed
+    #
+    # load(filepath) reads whatever the analysis of that image will need
+    # (see read_image) and iterating yields its results in the order of
+    # images. At most depth results wait in the queue (plus the one the
+    # thread is holding), so memory use doesn't grow with the number of
+    # images. If load raises, the error is raised from the iteration in its
+    # place.
+
+    def __init__(self, images, depth, load):
+
+        self.images = list(images)
+        self.load = load
+        self.queue = Queue.Queue(maxsize=max(1, depth))
+        self.stopped = threading.Event()
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+
+        for filepath in self.images:
+            try:
+                item = (self.load(filepath), None)
+            except Exception:
+                item = (None, sys.exc_info())
+
+            # wait for room, but give up if the consumer has stopped
+            while not self.stopped.is_set():
+                try:
+                    self.queue.put(item, timeout=0.1)
+                    break
+                except Queue.Full:
+                    continue
+
+            if self.stopped.is_set():
+                return
+
+    def __iter__(self):
+
+        for _ in xrange(len(self.images)):
+            item, error = self.queue.get()
+            if error is not None:
+                raise error[0], error[1], error[2]
+            yield item
+
+    def close(self):
+
+        self.stopped.set()
+        self.thread.join()
@@ -0,0 +1,156 @@
+from __future__ import division
+import numpy as np
+import cv2
+from skimage.filters import gaussian
+
+class Preprocessor(object):
+
+    # per-image preprocessing shared by every Clone stage
+    #
+    # CLAHE is computed once per image, blurred images are cached by sigma and
+    # edge maps are cached by (sigma, canny_minval, canny_maxval). Cached edge
+    # maps are read-only, so callers that mask edges must work on a copy.
+    # Downsampled copies of the image (for pyramid mode) are cached by scale.
+    #
+    # crop() returns a Preprocessor for a region of the image that shares this
+    # one's CLAHE; origin is the region's top-left corner, and edge indices
+    # of a region are in full-image coordinates. A region's edge map is a
+    # view of the whole image's when that has already been computed.
+
+    def __init__(self, im, origin=(0, 0), parent=None):
+
+        self.image = im
+        self.origin = origin
+        self.parent = parent
+        self.hc = None
+        self.blurred = {}
+        self.edge_maps = {}
+        self.edge_indices = {}
+        self.pyramid = {}
+        self.crops = {}
+
+    def high_contrast(self):
+
+        if self.hc is None:
+            clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
+            self.hc = clahe.apply(np.ascontiguousarray(self.image))
+        return self.hc
+
+    def blur(self, sigma):
+
+        try:
+            return self.blurred[sigma]
+        except KeyError:
+            blurred = np.array(255*gaussian(self.high_contrast(), sigma), dtype=np.uint8)
+            self.blurred[sigma] = blurred
+            return blurred
+
+    def edges(self, sigma, minval, maxval):
+
+        key = (sigma, minval, maxval)
+
+        try:
+            return self.edge_maps[key]
+        except KeyError:
+            pass
+
+        if (self.parent is not None) and (key in self.parent.edge_maps):
+            x0, y0 = self.origin[0] - self.parent.origin[0], self.origin[1] - self.parent.origin[1]
+            h, w = self.image.shape
+            edges = self.parent.edge_maps[key][x0:x0+h, y0:y0+w]
+        else:
+            # edge pixels are stored as 0/1 uint8 rather than float
+            edges = cv2.Canny(self.blur(sigma), minval, maxval)//255
+            edges.flags.writeable = False
+
+        self.edge_maps[key] = edges
+        return edges
+
+    def edge_index(self, sigma, minval, maxval):
+
+        key = (sigma, minval, maxval)
+
+        try:
+            return self.edge_indices[key]
+        except KeyError:
+            index = EdgeIndex(self.edges(sigma, minval, maxval), self.origin)
+            self.edge_indices[key] = index
+            return index
+
+    def crop(self, x0, x1, y0, y1):
+
+        key = (x0, x1, y0, y1)
+
+        try:
+            return self.crops[key]
+        except KeyError:
+            region = Preprocessor(self.image[x0:x1, y0:y1], (self.origin[0] + x0, self.origin[1] + y0), self)
+            region.hc = self.high_contrast()[x0:x1, y0:y1]
+            self.crops[key] = region
+            return region
+
+    def clear(self):
+
+        # drops the cached blurs and edge indices, keeping CLAHE and the
+        # edge maps (which crops share) and the crops themselves
+        self.blurred = {}
+        self.edge_indices = {}
+
+    def downsampled(self, scale):
+
+        try:
+            return self.pyramid[scale]
+        except KeyError:
+            h, w = self.image.shape
+            small = cv2.resize(self.image, (w//scale, h//scale), interpolation=cv2.INTER_AREA)
+            self.pyramid[scale] = small
+            return small
+
+    def edges_window(self, sigma, minval, maxval, x0, x1, y0, y1):
+
+        # edge map of the window [x0:x1, y0:y1] only. The blur and Canny are
+        # run on a padded crop of the contrast-enhanced image, so away from
+        # the crop border the result matches the same window of edges().
+
+        key = (sigma, minval, maxval)
+        if key in self.edge_maps:
+            return self.edge_maps[key][x0:x1, y0:y1]
+
+        h, w = self.image.shape
+        pad = int(4*sigma) + 8
+        px0, px1 = max(0, x0 - pad), min(h, x1 + pad)
+        py0, py1 = max(0, y0 - pad), min(w, y1 + pad)
+
+        blurred = np.array(255*gaussian(self.high_contrast()[px0:px1, py0:py1], sigma), dtype=np.uint8)
+        edges = cv2.Canny(blurred, minval, maxval)//255
+        return edges[x0-px0:x1-px0, y0-py0:y1-py0]
+
+class EdgeIndex(object):
+
+    # coordinates of the pixels in an edge map, extracted once so that the
+    # repeated line queries in find_edge2 don't rescan the whole image. For
+    # the edge map of a crop, origin maps them back to the full image.
+
+    def __init__(self, edges, origin=(0, 0)):
+
+        self.x, self.y = np.where(edges)
+        self.x += origin[0]
+        self.y += origin[1]
+        self.points = np.transpose(np.vstack([self.x, self.y]))
+
+        self.xf = self.x.astype(float)
+        self.yf = self.y.astype(float)
+
+    def __len__(self):
+
+        return len(self.x)
+
+    def near_line(self, m, b, percentile=2):
+
+        # returns the edge pixels whose squared residual to y = m*x + b is
+        # below the given percentile of all residuals
+
+        diff = self.yf - (m*self.xf + b)
+        diff *= diff
+
+        return self.points[diff < np.percentile(diff, percentile)]
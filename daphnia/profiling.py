@@ -0,0 +1,177 @@
+import os
+import time
+import json
+import heapq
+import hashlib
+import marshal
+import cProfile
+from collections import OrderedDict
+
+def status_kb(field):
+
+    # a memory field (e.g. VmRSS) of /proc/self/status in kB, or None where
+    # /proc isn't available
+
+    try:
+        with open("/proc/self/status", "rb") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+def reset_peak_rss():
+
+    # resets this process's peak RSS (VmHWM) to its current RSS, so that
+    # status_kb("VmHWM") gives the peak from here on. Returns False where the
+    # kernel doesn't support it.
+
+    try:
+        with open("/proc/self/clear_refs", "wb") as f:
+            f.write("5")
+        return True
+    except (IOError, OSError):
+        return False
+
+class StageProfile(object):
+
+    # wall time of each stage run for one image, the peak RSS during each
+    # stage (if memory is set) and the clone's work counters
+    #
+    # The peak is reset at the start of every stage, so peak_rss[stage] (kB) is
+    # the high-water mark while that stage ran, not the process's peak so far.
+    # A stage's peak is None where the reset isn't supported.
+
+    def __init__(self, filepath, memory=False):
+
+        self.filepath = filepath
+        self.memory = memory
+        self.times = OrderedDict()
+        self.peak_rss = OrderedDict()
+        self.peak_reset = False
+        self.counters = {}
+        self.reused = []
+        self.total = 0.0
+        self.profile_path = None
+        self.stats = None
+        self.started = None
+
+    def start(self, stage):
+
+        if self.memory:
+            self.peak_reset = reset_peak_rss()
+        self.started = time.time()
+
+    def stop(self, stage):
+
+        self.times[stage] = time.time() - self.started
+        if self.memory:
+            self.peak_rss[stage] = status_kb("VmHWM") if self.peak_reset else None
+
+    def record(self):
+
+        return OrderedDict([("filepath", self.filepath),
+            ("total", self.total),
+            ("stages", self.times),
+            ("peak_rss", self.peak_rss if self.memory else None),
+            ("reused", self.reused),
+            ("counters", self.counters),
+            ("profile", self.profile_path)])
+
+def profile_stages(run, profile, cprofile=False):
+
+    # calls run(), recording its total time on profile. With cprofile, the
+    # call runs under cProfile and the stats are kept on profile.stats, in
+    # the format pstats reads, for RunReport to write out.
+
+    profiler = None
+    if cprofile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    t0 = time.time()
+    try:
+        run()
+    finally:
+        profile.total = time.time() - t0
+
+        if profiler is not None:
+            profiler.disable()
+            profiler.create_stats()
+            profile.stats = marshal.dumps(profiler.stats)
+
+def profile_filename(filepath):
+
+    # images with the same name in different directories get different dumps
+    return os.path.basename(filepath) + "_" + hashlib.sha1(os.path.abspath(filepath)).hexdigest()[0:10] + ".prof"
+
+class RunReport(object):
+
+    # collects StageProfiles for a run and writes them as JSON, together with
+    # per-stage totals. The cProfile stats of the keep_profiles slowest
+    # images are held in memory (the rest are dropped as they arrive) and
+    # written to profile_dir along with the report.
+
+    def __init__(self, path, keep_profiles=0, profile_dir=None):
+
+        self.path = path
+        self.keep_profiles = keep_profiles
+        self.profile_dir = profile_dir
+        self.profiles = []
+        self.slowest = []
+        self.cached = []
+        self.started = time.time()
+
+    def add(self, profile):
+
+        self.profiles.append(profile)
+
+        if profile.stats is None:
+            return
+
+        # min-heap on total time, so the fastest kept profile is evicted
+        entry = (profile.total, len(self.profiles), profile)
+        if len(self.slowest) < self.keep_profiles:
+            heapq.heappush(self.slowest, entry)
+        else:
+            if self.keep_profiles:
+                entry = heapq.heappushpop(self.slowest, entry)
+            entry[2].stats = None
+
+    def add_cached(self, filepath):
+
+        self.cached.append(filepath)
+
+    def write_profiles(self):
+
+        for _, _, p in self.slowest:
+            if p.stats is not None:
+                p.profile_path = os.path.join(self.profile_dir, profile_filename(p.filepath))
+                with open(p.profile_path, "wb") as f:
+                    f.write(p.stats)
+                p.stats = None
+
+    def write(self):
+
+        if self.profile_dir is not None:
+            self.write_profiles()
+
+        stage_totals = OrderedDict()
+        counter_totals = {}
+        for p in self.profiles:
+            for stage, seconds in p.times.iteritems():
+                stage_totals[stage] = stage_totals.get(stage, 0.0) + seconds
+            for counter, n in p.counters.iteritems():
+                counter_totals[counter] = counter_totals.get(counter, 0) + n
+
+        report = OrderedDict([("wall_time", time.time() - self.started),
+            ("images", len(self.profiles) + len(self.cached)),
+            ("cached", self.cached),
+            ("stage_totals", stage_totals),
+            ("counter_totals", counter_totals),
+            ("slowest", [p.filepath for p in sorted(self.profiles, key=lambda p: p.total, reverse=True)[0:max(self.keep_profiles, 10)]]),
+            ("per_image", [p.record() for p in self.profiles])])
+
+        with open(self.path, "wb") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,188 @@
+from __future__ import division
+import click
+import sys, os
+import time
+import json
+import shutil
+import tempfile
+import numpy as np
+from collections import OrderedDict
+from daphnia.clone import Clone
+from daphnia.bmp import imread_grayscale
+from daphnia.stages import STAGE_NAMES, run_stages
+from daphnia.profiling import StageProfile
+from daphnia.synthetic import write_synthetic_set
+from daphnia.scripts.run_daphnia import DATA_COLS
+import daphnia.utils as utils
+
+# parameters used when no parameter file is given
+BENCHMARK_PARAMS = {"count_animal_pixels_blur": 1.0,
+        "count_animal_pixels_n": 100,
+        "count_animal_pixels_cc_threshold": 5,
+        "canny_minval": 0,
+        "canny_maxval": 50,
+        "find_eye_blur": 0.5,
+        "mask_antenna_blur": 1.5,
+        "edge_pixel_distance_threshold_multiplier": 2.5,
+        "mask_antenna_coronal_tilt": 2.0,
+        "mask_antenna_anterior_tilt": 0.5,
+        "mask_antenna_posterior_tilt": 0.5,
+        "fit_ellipse_chi2": 2.279,
+        "find_head_blur": 1.0,
+        "find_tail_blur": 1.0,
+        "dorsal_edge_blur": 1.0,
+        "analyze_pedestal_moving_avg_window": 100,
+        "analyze_pedestal_percentile": 80,
+        "analyze_pedestal_polyfit_degree": 3,
+        "pedestal_n": 400}
+
+# metrics compared against the synthetic ground truth
+TRUTH_COLS = ["animal_length", "eye_area", "tail_spine_length"]
+
+class quiet(object):
+
+    # silences the progress messages printed by the pipeline
+
+    def __enter__(self):
+
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+
+    def __exit__(self, *args):
+
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+def summarize(times):
+
+    times = np.array(times, dtype=float)
+    if len(times) == 0:
+        return None
+
+    return OrderedDict([("mean", np.mean(times)),
+        ("median", np.median(times)),
+        ("max", np.max(times))])
+
+def relative_error(measured, expected):
+
+    try:
+        return abs(float(measured) - expected)/expected
+    except (TypeError, ValueError):
+        return np.nan
+
+def benchmark_size(shape, n, params_dict, seed, workdir):
+
+    # times each stage, calc_pixel_to_mm and write_clone on n synthetic images
+
+    truth = write_synthetic_set(workdir, n=n, shape=shape, seed=seed)
+
+    stage_times = OrderedDict([(stage, []) for stage in STAGE_NAMES])
+    totals = []
+    micro_times = []
+    write_times = []
+    errors = OrderedDict([(col, []) for col in TRUTH_COLS + ["pixel_to_mm"]])
+    failures = []
+
+    writer = utils.ResultWriter(os.path.join(workdir, "out.txt"),
+            os.path.join(workdir, "shape.txt"),
+            os.path.join(workdir, "analysis_metadata.txt"))
+
+    for filebase, row in truth.iterrows():
+        filepath = os.path.join(workdir, filebase)
+
+        clone = Clone(filepath, **params_dict)
+        im = imread_grayscale(filepath)
+        profile = StageProfile(filepath)
+
+        t0 = time.time()
+        try:
+            with quiet():
+                run_stages(clone, im, profile=profile)
+        except Exception as e:
+            failures.append((filebase, "analyze_clone", str(e)))
+        totals.append(time.time() - t0)
+
+        for stage, seconds in profile.times.iteritems():
+            stage_times[stage].append(seconds)
+
+        for col in TRUTH_COLS:
+            errors[col].append(relative_error(getattr(clone, col), row[col]))
+
+        micro = imread_grayscale(filepath.replace("full", "fullMicro"))
+        t0 = time.time()
+        try:
+            with quiet():
+                pixel_to_mm = utils.calc_pixel_to_mm(micro)
+            micro_times.append(time.time() - t0)
+            errors["pixel_to_mm"].append(relative_error(pixel_to_mm, row["pixel_to_mm"]))
+        except Exception as e:
+            failures.append((filebase, "calc_pixel_to_mm", str(e)))
+
+        t0 = time.time()
+        with quiet():
+            writer.write_clone(clone.result(), DATA_COLS, [], {}, params_dict)
+        write_times.append(time.time() - t0)
+
+    t0 = time.time()
+    writer.close()
+    close_time = time.time() - t0
+
+    return OrderedDict([("size", "x".join([str(x) for x in shape])),
+        ("images", n),
+        ("analyze_clone", summarize(totals)),
+        ("stages", OrderedDict([(stage, summarize(t)) for stage, t in stage_times.iteritems()])),
+        ("calc_pixel_to_mm", summarize(micro_times)),
+        ("write_clone", summarize(write_times)),
+        ("writer_close", close_time),
+        ("median_relative_error", OrderedDict([(col, float(np.nanmedian(e)) if np.any(~np.isnan(e)) else None) for col, e in errors.iteritems()])),
+        ("failures", failures)])
+
+def parse_sizes(sizes):
+
+    return [tuple([int(x) for x in size.split("x")]) for size in sizes.split(",")]
+
+@click.command()
+@click.option('--params', default=None, help='Path to parameter file (defaults to built-in values).')
+@click.option('--sizes', default='1200x1600,2400x3200', help='Comma-separated image sizes as rowsxcolumns.')
+@click.option('--n', default=5, type=int, help='Number of synthetic images per size.')
+@click.option('--seed', default=0, type=int, help='Random seed for the synthetic images.')
+@click.option('--output', default=None, help='Path to write the JSON report to.')
+@click.option('--keep', is_flag=True, help='Keep the generated images and output files.')
+
+def benchmark(params, sizes, n, seed, output, keep):
+
+    # benchmarks the pipeline on synthetic images; needs no data or network
+
+    params_dict = dict(BENCHMARK_PARAMS)
+    if params is not None:
+        params_dict.update(utils.myParse(params))
+
+    results = []
+
+    for shape in parse_sizes(sizes):
+        workdir = tempfile.mkdtemp(prefix="daphnia_benchmark_")
+        click.echo('Benchmarking {0} images at {1}x{2} in {3}'.format(n, shape[0], shape[1], workdir))
+
+        try:
+            result = benchmark_size(shape, n, params_dict, seed, workdir)
+        finally:
+            if not keep:
+                shutil.rmtree(workdir)
+
+        results.append(result)
+
+        for stage, summary in result["stages"].iteritems():
+            if summary is not None:
+                click.echo('  {0:<20} {1:8.3f}s'.format(stage, summary["median"]))
+        for key in ["analyze_clone", "calc_pixel_to_mm", "write_clone"]:
+            if result[key] is not None:
+                click.echo('  {0:<20} {1:8.3f}s'.format(key, result[key]["median"]))
+        for name, stage, message in result["failures"]:
+            click.echo('  {0} failed on {1}: {2}'.format(stage, name, message))
+
+    if output is not None:
+        with open(output, "wb") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    benchmark()
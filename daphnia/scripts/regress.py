@@ -0,0 +1,166 @@
+from __future__ import division
+import click
+import sys, os
+import json
+import pickle
+import shutil
+import subprocess
+import tempfile
+import numpy as np
+from collections import OrderedDict
+from daphnia.stages import STAGE_NAMES
+from daphnia.synthetic import write_synthetic_set
+from daphnia.scripts.run_daphnia import DATA_COLS
+
+RUNNER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "regression_runner.py")
+
+# output columns that are bookkeeping rather than measurements
+SKIP_COLS = ["filepath", "accepted", "modified", "modification_notes", "modifier"]
+METRIC_COLS = [c for c in DATA_COLS if c not in SKIP_COLS]
+
+# per-point columns of the shape table (its checkpoint flags come from the
+# checkpoints)
+SHAPE_COLS = ["dorsal_edge", "q", "qi", "checkpoints"]
+
+def run_version(root, params, images, workdir, name):
+
+    # analyzes images with the package under root, in a separate interpreter
+
+    output = os.path.join(workdir, name + ".pkl")
+    subprocess.check_call([sys.executable, RUNNER, root, params, output] + list(images))
+
+    with open(output, "rb") as f:
+        return pickle.load(f)
+
+def values_match(a, b, rtol, atol):
+
+    try:
+        a = np.asarray(a, dtype=float)
+        b = np.asarray(b, dtype=float)
+    except (TypeError, ValueError):
+        return a == b
+
+    if a.shape != b.shape:
+        return False
+    return np.allclose(a, b, rtol=rtol, atol=atol, equal_nan=True)
+
+def difference(a, b):
+
+    # largest absolute difference between two values, or a note saying why
+    # there isn't one
+
+    try:
+        a = np.asarray(a, dtype=float)
+        b = np.asarray(b, dtype=float)
+    except (TypeError, ValueError):
+        return "{0!r} != {1!r}".format(a, b)
+
+    if a.shape != b.shape:
+        return "shape {0} != {1}".format(a.shape, b.shape)
+    return float(np.nanmax(np.abs(a - b)))
+
+def compare_records(baseline, candidate, rtol, atol):
+
+    # returns a list of (filepath, column, difference) for every metric or
+    # shape column that doesn't agree within tolerance
+
+    mismatches = []
+
+    for b, c in zip(baseline, candidate):
+        for col in METRIC_COLS + SHAPE_COLS:
+            bval = b["clone"].get(col, np.nan)
+            cval = c["clone"].get(col, np.nan)
+            if not values_match(bval, cval, rtol, atol):
+                mismatches.append((b["filepath"], col, difference(bval, cval)))
+
+    return mismatches
+
+def timing_table(baseline, candidate):
+
+    # mean seconds per image for each stage (and in total) in both versions
+
+    rows = []
+    for stage in STAGE_NAMES + ["total"]:
+        if stage == "total":
+            btimes = [r["total"] for r in baseline]
+            ctimes = [r["total"] for r in candidate]
+        else:
+            btimes = [r["stages"][stage] for r in baseline if stage in r["stages"]]
+            ctimes = [r["stages"][stage] for r in candidate if stage in r["stages"]]
+
+        bmean = np.mean(btimes) if len(btimes) > 0 else np.nan
+        cmean = np.mean(ctimes) if len(ctimes) > 0 else np.nan
+        rows.append(OrderedDict([("stage", stage),
+            ("baseline", bmean),
+            ("candidate", cmean),
+            ("delta", cmean - bmean),
+            ("ratio", cmean/bmean if bmean > 0 else np.nan)]))
+
+    return rows
+
+@click.command()
+@click.option('--baseline', required=True, type=click.Path(exists=True), help='Root directory of the baseline version of the package.')
+@click.option('--candidate', default=None, type=click.Path(exists=True), help='Root directory of the candidate version (defaults to this one).')
+@click.option('--params', default='params.txt', type=click.Path(exists=True), help='Path to parameter file.')
+@click.option('--synthetic', default=0, type=int, help='Add this many synthetic images to the golden set.')
+@click.option('--rtol', default=1e-6, type=float, help='Relative tolerance for metric and shape comparisons.')
+@click.option('--atol', default=1e-6, type=float, help='Absolute tolerance for metric and shape comparisons.')
+@click.option('--output', default=None, help='Path to write the JSON report to.')
+@click.argument('images', nargs=-1, type=click.Path(exists=True))
+
+def regress(baseline, candidate, params, synthetic, rtol, atol, output, images):
+
+    # runs a golden image set through two versions of the pipeline and
+    # compares their results and stage timings; exits with status 1 if any
+    # result differs beyond tolerance
+
+    if candidate is None:
+        candidate = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    workdir = tempfile.mkdtemp(prefix="daphnia_regress_")
+
+    try:
+        images = list(images)
+        if synthetic > 0:
+            truth = write_synthetic_set(os.path.join(workdir, "images"), n=synthetic)
+            images += [os.path.join(workdir, "images", filebase) for filebase in truth.index]
+
+        if len(images) == 0:
+            raise click.UsageError("No images given (pass image paths or --synthetic N).")
+
+        click.echo('Running {0} images through {1}'.format(len(images), baseline))
+        baseline_records = run_version(baseline, params, images, workdir, "baseline")
+        click.echo('Running {0} images through {1}'.format(len(images), candidate))
+        candidate_records = run_version(candidate, params, images, workdir, "candidate")
+    finally:
+        shutil.rmtree(workdir)
+
+    mismatches = compare_records(baseline_records, candidate_records, rtol, atol)
+    timings = timing_table(baseline_records, candidate_records)
+
+    click.echo('\n{0:<14}{1:>12}{2:>12}{3:>12}{4:>8}'.format("stage", "baseline", "candidate", "delta", "ratio"))
+    for row in timings:
+        click.echo('{0:<14}{1:>12.4f}{2:>12.4f}{3:>+12.4f}{4:>8.2f}'.format(row["stage"], row["baseline"], row["candidate"], row["delta"], row["ratio"]))
+
+    click.echo('')
+    for filepath, col, diff in mismatches:
+        click.echo('MISMATCH {0} {1}: {2}'.format(os.path.basename(filepath), col, diff))
+    click.echo('{0} mismatches in {1} images'.format(len(mismatches), len(images)))
+
+    if output is not None:
+        report = OrderedDict([("baseline", os.path.abspath(baseline)),
+            ("candidate", os.path.abspath(candidate)),
+            ("rtol", rtol),
+            ("atol", atol),
+            ("images", images),
+            ("timings", timings),
+            ("mismatches", mismatches)])
+
+        with open(output, "wb") as f:
+            json.dump(report, f, indent=2)
+
+    if len(mismatches) > 0:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    regress()
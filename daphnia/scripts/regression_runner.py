@@ -0,0 +1,74 @@
+import sys, os
+import time
+import pickle
+
+# runs images through the daphnia package found under a given root directory
+# and pickles each clone's results and stage timings
+#
+# This is started by daphnia_regress in a fresh interpreter for each version
+# being compared, so it must not import daphnia before sys.path is set, and
+# it has to work with versions that predate daphnia.stages.
+#
+# usage: regression_runner.py ROOT PARAMS OUTPUT IMAGE [IMAGE ...]
+
+# intermediates that are too large to compare or keep
+SKIP_ATTRIBUTES = set(["preprocessor", "edges", "edge_copy", "eye_pts", "whole_animal_points"])
+
+def clone_record(clone):
+
+    return dict([(k, v) for k, v in vars(clone).iteritems() if k not in SKIP_ATTRIBUTES])
+
+def main(root, params, output, images):
+
+    sys.path.insert(0, os.path.abspath(root))
+
+    import cv2
+    from daphnia.clone import Clone
+    import daphnia.utils as utils
+    from daphnia.scripts.run_daphnia import analyze_clone
+
+    try:
+        from daphnia.stages import run_stages
+        from daphnia.profiling import StageProfile
+    except ImportError:
+        run_stages = None
+
+    params_dict = utils.myParse(params)
+    records = []
+
+    for image in images:
+        clone = Clone(image, **params_dict)
+        im = cv2.imread(clone.filepath, cv2.IMREAD_GRAYSCALE)
+
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+
+        error = None
+        stages = {}
+        t0 = time.time()
+        try:
+            if run_stages is not None:
+                profile = StageProfile(image)
+                try:
+                    run_stages(clone, im, profile=profile)
+                except Exception as e:
+                    error = str(e)
+                stages = dict(profile.times)
+            else:
+                analyze_clone(clone, im)
+        finally:
+            total = time.time() - t0
+            sys.stdout.close()
+            sys.stdout = stdout
+
+        records.append({"filepath": image,
+            "total": total,
+            "stages": stages,
+            "error": error,
+            "clone": clone_record(clone)})
+
+    with open(output, "wb") as f:
+        pickle.dump(records, f, pickle.HIGHEST_PROTOCOL)
+
+if __name__ == '__main__':
+    main(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4:])
@@ -1,116 +1,302 @@
 import click
 import cv2
 import sys, os
+import re
+import ctypes
+import multiprocessing
 from daphnia.clone import Clone
+from daphnia.bmp import imread_grayscale
+from daphnia.cache import ResultCache, file_digest
+from daphnia.stages import StageStore, run_stages
+from daphnia.profiling import StageProfile, RunReport, profile_stages
+from daphnia.prefetch import ImagePrefetcher, read_image
 from daphnia.daphnia_plot import plot as daphnia_plot
 from ast import literal_eval
 import daphnia.utils as utils
 import numpy as np
 
-def analyze_clone(clone, im):
+def analyze_clone(clone, im, store=None, resume=True, profile=None, image_digest=None):
 
+    # with a StageStore, stages whose inputs haven't changed are restored
+    # from their saved artifacts rather than re-run
     try:
-        print "Detecting eye"
-        clone.find_eye(im)
-        print "Masking antenna"
-        clone.find_features(im)
-        print "Estimating area"
-        clone.get_orientation_vectors()
-        clone.eye_vertices()
-
-        clone.find_head(im)
-        clone.initialize_dorsal_edge(im)
-        clone.fit_dorsal_edge(im)
-        clone.find_tail(im)
-        clone.remove_tail_spine()
-
-        clone.get_animal_length()
-        clone.get_animal_dorsal_area()
-
-        print "Fitting and analyzing pedestal"
-        clone.qscore()
-
-        clone.analyze_pedestal()
+        run_stages(clone, im, store, resume, profile, image_digest)
     except Exception as e:
+        clone.failed = True
         print "Error analyzing " + str(clone.filepath) + ": " + str(e)
 
+def analyze_image(image_filepath, params_dict, metadata_sources=None, plot_params_dict=None, store=None, profile=None, preloaded=(None, None), image_digest=None):
+
+    # preloaded is (image, micrometer image), either of which may be None
+    # if it hasn't been read yet. image_digest is the image's file_digest,
+    # if it has already been computed.
+
+    click.echo('Analyzing {0}'.format(image_filepath))
+    clone = Clone(image_filepath, **params_dict)
+
+    im, micro_im = preloaded
+    if im is None:
+        im = imread_grayscale(clone.filepath)
+
+    # plots need the intermediates that aren't stored, so don't resume
+    resume = (plot_params_dict is None)
+
+    if profile is None:
+        analyze_clone(clone, im, store, resume, None, image_digest)
+    else:
+        profile_stages(lambda: analyze_clone(clone, im, store, resume, profile, image_digest), profile, params_dict.get('profile_slowest', 0) > 0)
+        profile.counters = dict(clone.counters)
+    
+    metadata = {}
+    if metadata_sources is not None:
+        metadata = utils.build_metadata_dict(image_filepath, *metadata_sources, micro_im=micro_im)
+
+    if plot_params_dict is not None:
+        clone.filebase = metadata.get('filebase', clone.filebase)
+        daphnia_plot(clone, im, plot_params_dict)
+
+    return clone, metadata
+
+def analyze_image_result(image_filepath, params_dict, metadata_sources=None, plot_params_dict=None, cache=None, store=None, preloaded=(None, None), image_digest=None):
+
+    # returns (result, metadata, profile), reusing the cached result when
+    # neither the image nor the parameters have changed (plots need the full
+    # analysis, so they always recompute). profile is a StageProfile if
+    # stage_report is set and the image was analyzed, otherwise None.
+    # image_digest is the image's file_digest, if it has already been
+    # computed.
+
+    # the image is hashed once for both the cache and the stage store
+    if (image_digest is None) and ((cache is not None) or (store is not None)):
+        image_digest = file_digest(image_filepath)
+
+    key = None
+    if cache is not None:
+        key = cache.key(image_filepath, params_dict, image_digest)
+
+        if plot_params_dict is None:
+            result = cache.get(key, image_filepath)
+            if result is not None:
+                click.echo('Using cached result for {0}'.format(image_filepath))
+                
+                metadata = {}
+                if metadata_sources is not None:
+                    metadata = utils.build_metadata_dict(image_filepath, *metadata_sources, micro_im=preloaded[1])
+
+                return result, metadata, None
+
+    profile = None
+    if params_dict.get('stage_report'):
+        profile = StageProfile(image_filepath, memory=params_dict.get('stage_report_memory', 0))
+
+    clone, metadata = analyze_image(image_filepath, params_dict, metadata_sources, plot_params_dict, store, profile, preloaded, image_digest)
+    result = clone.result()
+
+    # a failure may be transient (memory, I/O), so it's retried next run
+    if (cache is not None) and not result.failed:
+        cache.put(key, result)
+
+    return result, metadata, profile
+
+def prefetch_image(image_filepath, params_dict, metadata_sources=None, plot_params_dict=None, cache=None, store=None, sessions=None):
+
+    # the read-ahead for one image, run on the prefetch thread. Returns
+    # (image_filepath, preloaded, image_digest) as analyze_image_result takes
+    # them. The image isn't read when its result will come from the cache,
+    # nor the micrometer image when the calibration registry already has its
+    # scale (sessions is as for utils.micrometer_needed).
+
+    image_digest = None
+    if (cache is not None) or (store is not None):
+        image_digest = file_digest(image_filepath)
+
+    im = None
+    if (cache is None) or (plot_params_dict is not None) or (cache.key(image_filepath, params_dict, image_digest) not in cache):
+        im = read_image(image_filepath)
+
+    micro_im = None
+    if metadata_sources is not None:
+        if utils.micrometer_needed(image_filepath, metadata_sources[-2], metadata_sources[-1], sessions):
+            micro_im = read_image(image_filepath.replace("full", "fullMicro"))
+
+    return image_filepath, (im, micro_im), image_digest
+
+def report_profile_dir(params_dict):
+
+    # cProfile dumps go next to the stage report unless profile_dir is set
+    return params_dict.get('profile_dir', os.path.dirname(os.path.abspath(params_dict['stage_report'])))
+
+# (library name pattern, function setting its thread count) for the
+# BLAS/OpenMP runtimes numpy and cv2 may have loaded
+THREAD_SETTERS = [(r"openblas", "openblas_set_num_threads"),
+        (r"mkl_rt", "MKL_Set_Num_Threads"),
+        (r"gomp", "omp_set_num_threads"),
+        (r"iomp5", "omp_set_num_threads")]
+
+WORKER_ARGS = {}
+
+def loaded_libraries():
+
+    # paths of the shared libraries mapped into this process; empty where
+    # /proc isn't available
+    try:
+        with open("/proc/self/maps") as f:
+            paths = [line.split()[-1] for line in f if ".so" in line]
+    except IOError:
+        return []
+
+    return sorted(set([p for p in paths if os.path.isfile(p)]))
+
+def limit_threads(n=1):
+
+    # keeps each worker process from spawning its own pool of threads. The
+    # OMP_NUM_THREADS etc. variables are only read when a library loads, and
+    # numpy and cv2 are already loaded here, so the runtimes are capped
+    # through their own setters instead.
+
+    cv2.setNumThreads(n)
+
+    for path in loaded_libraries():
+        name = os.path.basename(path)
+        for pattern, setter in THREAD_SETTERS:
+            if re.search(pattern, name):
+                try:
+                    getattr(ctypes.CDLL(path), setter)(ctypes.c_int(n))
+                except (OSError, AttributeError):
+                    continue
+
+def init_worker(params_dict, metadata_sources, plot_params_dict, cache, store):
+
+    limit_threads()
+    WORKER_ARGS['params_dict'] = params_dict
+    WORKER_ARGS['metadata_sources'] = metadata_sources
+    WORKER_ARGS['plot_params_dict'] = plot_params_dict
+    WORKER_ARGS['cache'] = cache
+    WORKER_ARGS['store'] = store
+
+def analyze_image_worker(image_filepath):
+
+    # only the compact result record is sent back to the writer
+    return analyze_image_result(image_filepath, **WORKER_ARGS)
+
+def analyze_images(images, params_dict, metadata_sources=None, plot_params_dict=None, jobs=1, cache=None, store=None, prefetch_depth=0):
+
+    # yields (result, metadata, profile) for each image, in the same order as
+    # images. When analyzing serially with prefetch_depth > 0, up to that
+    # many images (and the micrometer images that will be measured) are read
+    # ahead on a background thread; worker processes already overlap reading
+    # with analysis, so jobs > 1 doesn't prefetch.
+
+    if (jobs <= 1) and (prefetch_depth > 0):
+        sessions = set()
+        load = lambda image_filepath: prefetch_image(image_filepath, params_dict, metadata_sources, plot_params_dict, cache, store, sessions)
+
+        prefetcher = ImagePrefetcher(images, prefetch_depth, load)
+        try:
+            for image_filepath, preloaded, image_digest in prefetcher:
+                yield analyze_image_result(image_filepath, params_dict, metadata_sources, plot_params_dict, cache, store, preloaded, image_digest)
+        finally:
+            prefetcher.close()
+        return
+
+    if jobs <= 1:
+        for image_filepath in images:
+            yield analyze_image_result(image_filepath, params_dict, metadata_sources, plot_params_dict, cache, store)
+        return
+
+    pool = multiprocessing.Pool(jobs, init_worker, (params_dict, metadata_sources, plot_params_dict, cache, store))
+    
+    try:
+        for result in pool.imap(analyze_image_worker, images):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+# columns written to the output file for each clone
+DATA_COLS = ["filepath",
+        "animal_dorsal_area",
+        "eye_area",
+        "animal_length",
+        "animal_x_center",
+        "animal_y_center",
+        "animal_major",
+        "animal_minor",
+        "animal_theta",
+        "eye_x_center",
+        "eye_y_center",
+        "anterior",
+        "posterior",
+        "dorsal",
+        "ventral",
+        "ant_vec",
+        "pos_vec",
+        "dor_vec",
+        "ven_vec",
+        "eye_dorsal",
+        "eye_ventral",
+        "head",
+        "tail",
+        "tail_tip",
+        "tail_base",
+        "tail_spine_length",
+        "tail_dorsal",
+        "ventral_mask_endpoints",
+        "dorsal_mask_endpoints",
+        "anterior_mask_endpoints",
+        "pedestal_max_height",
+        "pedestal_area",
+        "poly_coeff",
+        "res",
+        "peak",
+        "deyecenter_pedestalmax",
+        "dorsal_residual",
+        "accepted",
+        "modified",
+        "modification_notes",
+        "modifier",
+        "automated_PF",
+        "automated_PF_reason"]
+METADATA_FIELDS = ["filebase",
+        "barcode",
+        "cloneid",
+        "pond",
+        "id",
+        "treatment",
+        "replicate",
+        "rig",
+        "datetime",
+        "inductiondate",
+        "manual_PF",
+        "manual_PF_reason",
+        "manual_PF_curator",
+        "pixel_to_mm",
+        "season",
+        "animal_dorsal_area_mm",
+        "animal_length_mm",
+        "eye_area_mm",
+        "tail_spine_length_mm",
+        "deyecenter_pedestalmax_mm",
+        "pedestal_area_mm",
+        "pedestal_max_height_mm",
+        "experimenter",
+        "inducer"]
+
 @click.command()
 @click.option('--params', default='params.txt', help='Path to parameter file.')
 @click.option('--plot', is_flag=True, help='Generates overlay on input image')
 @click.option('--plot_params', default='plot_params.txt', help='Path to plot parameter file.')
+@click.option('--jobs', default=1, type=int, help='Number of images to analyze in parallel.')
 @click.argument('images', nargs=-1,type=click.Path(exists=True))
 
-def daphnia(params, images, plot, plot_params):
+def daphnia(params, images, plot, plot_params, jobs):
     
-    DATA_COLS = ["filepath",
-            "animal_dorsal_area",
-            "eye_area",
-            "animal_length",
-            "animal_x_center",
-            "animal_y_center",
-            "animal_major",
-            "animal_minor",
-            "animal_theta",
-            "eye_x_center",
-            "eye_y_center",
-            "anterior",
-            "posterior",
-            "dorsal",
-            "ventral",
-            "ant_vec",
-            "pos_vec",
-            "dor_vec",
-            "ven_vec",
-            "eye_dorsal",
-            "eye_ventral",
-            "head",
-            "tail",
-            "tail_tip",
-            "tail_base",
-            "tail_spine_length",
-            "tail_dorsal",
-            "ventral_mask_endpoints",
-            "dorsal_mask_endpoints",
-            "anterior_mask_endpoints",
-            "pedestal_max_height",
-            "pedestal_area",
-            "poly_coeff",
-            "res",
-            "peak",
-            "deyecenter_pedestalmax",
-            "dorsal_residual",
-            "accepted",
-            "modified",
-            "modification_notes",
-            "modifier",
-            "automated_PF",
-            "automated_PF_reason"]
-    METADATA_FIELDS = ["filebase",
-            "barcode",
-            "cloneid",
-            "pond",
-            "id",
-            "treatment",
-            "replicate",
-            "rig",
-            "datetime",
-            "inductiondate",
-            "manual_PF",
-            "manual_PF_reason",
-            "manual_PF_curator",
-            "pixel_to_mm",
-            "season",
-            "animal_dorsal_area_mm",
-            "animal_length_mm",
-            "eye_area_mm",
-            "tail_spine_length_mm",
-            "deyecenter_pedestalmax_mm",
-            "pedestal_area_mm",
-            "pedestal_max_height_mm",
-            "experimenter",
-            "inducer"]
-
     params_dict = utils.myParse(params)
+    plot_params_dict = None
+    metadata_sources = None
 
     if plot:
         
@@ -118,30 +304,58 @@ def daphnia(params, images, plot, plot_params):
     
     if params_dict['load_metadata']:
         
-        curation_data = utils.load_manual_curation(params_dict['curation_csvpath'])
-        males_list = utils.load_male_list(params_dict['male_listpath'])
-        induction_dates = utils.load_induction_data(params_dict['induction_csvpath'])
-        season_data = utils.load_pond_season_data(params_dict['pond_season_csvpath'])
-        early_release = utils.load_release_data(params_dict['early_release_csvpath'])
-        late_release = utils.load_release_data(params_dict['late_release_csvpath'])
-        duplicate_data = utils.load_duplicate_data(params_dict['duplicate_csvpath'])
-        experimenter_data, inducer_data = utils.load_experimenter_data(params_dict['experimenter_csvpath'])
-
-    for image_filepath in images:
-        
-        click.echo('Analyzing {0}'.format(image_filepath))
-        clone = Clone(image_filepath, **params_dict)
-        im = cv2.imread(clone.filepath, cv2.IMREAD_GRAYSCALE)
-        analyze_clone(clone, im)
-        
-        if params_dict['load_metadata']:
-            metadata = utils.build_metadata_dict(image_filepath, curation_data, males_list, induction_dates, season_data, early_release, late_release, duplicate_data, experimenter_data, inducer_data)
-
-        utils.write_clone(clone, DATA_COLS, metadata.keys(), metadata, params_dict['output'], params_dict['shape_output'])
-        utils.write_analysis_metadata(clone, params_dict, params_dict['analysis_metadata_output'])
-        if plot:
-            clone.filebase = metadata['filebase']
-            daphnia_plot(clone, im, plot_params_dict)
+        tables = utils.load_metadata_sources(params_dict, jobs)
+
+        manual_scales = None
+        if params_dict.get('manual_scales_path'):
+            manual_scales = utils.load_manual_scales(params_dict['manual_scales_path'])
+        calibration = utils.CalibrationRegistry(params_dict.get('calibration_path'),
+                manual_scales,
+                by_session=params_dict.get('calibration_by_session', 0))
+
+        # pixel_to_mm is left as None so that it's looked up in the registry
+        metadata_sources = tables + (None, calibration)
+
+    cache = None
+    if params_dict.get('result_cache'):
+        cache = ResultCache(params_dict['result_cache'])
+
+    store = None
+    if params_dict.get('stage_artifacts'):
+        store = StageStore(params_dict['stage_artifacts'])
+
+    report = None
+    if params_dict.get('stage_report'):
+        profile_dir = None
+        if params_dict.get('profile_slowest', 0):
+            profile_dir = report_profile_dir(params_dict)
+            utils.makedirs(profile_dir)
+
+        report = RunReport(params_dict['stage_report'], params_dict.get('profile_slowest', 0), profile_dir)
+
+    writer = utils.ResultWriter(params_dict['output'],
+            params_dict['shape_output'],
+            params_dict['analysis_metadata_output'],
+            flush_rows=params_dict.get('output_flush_rows', 1000),
+            checkpoint_clones=params_dict.get('output_checkpoint_clones', 10),
+            columnar_output=params_dict.get('columnar_output'),
+            columnar_shape_output=params_dict.get('columnar_shape_output'))
+
+    # results come back in input order and are written by this process only
+    try:
+        for result, metadata, profile in analyze_images(images, params_dict, metadata_sources, plot_params_dict, jobs, cache, store, params_dict.get('prefetch_depth', 0)):
+            writer.write_clone(result, DATA_COLS, metadata.keys(), metadata, params_dict)
+
+            if report is not None:
+                if profile is None:
+                    report.add_cached(result.filepath)
+                else:
+                    report.add(profile)
+    finally:
+        writer.close()
+
+        if report is not None:
+            report.write()
 
 if __name__ == '__main__':
     daphnia()
@@ -0,0 +1,156 @@
+import hashlib
+import pickle
+from cache import CACHE_VERSION, file_digest
+from clone import PARAMETERS, ADJUSTED_PARAMETERS
+from utils import PickleStore
+
+# analysis pipeline in order: (stage, progress message, [(Clone method, takes image)])
+STAGES = [("eye", "Detecting eye", [("find_eye", True)]),
+        ("features", "Masking antenna", [("find_features", True),
+            ("crop_to_animal", True)]),
+        ("head", "Estimating area", [("get_orientation_vectors", False),
+            ("eye_vertices", False),
+            ("find_head", True)]),
+        ("dorsal_edge", None, [("initialize_dorsal_edge", True),
+            ("fit_dorsal_edge", True)]),
+        ("tail", None, [("find_tail", True),
+            ("remove_tail_spine", False),
+            ("get_animal_length", False),
+            ("get_animal_dorsal_area", False)]),
+        ("qscore", "Fitting and analyzing pedestal", [("qscore", False)]),
+        ("pedestal", None, [("analyze_pedestal", False)])]
+
+STAGE_NAMES = [stage for stage, _, _ in STAGES]
+
+# stages that read each parameter directly (every later stage depends on it
+# too, through the clone state). count_animal_pixels isn't part of the
+# pipeline, so its parameters don't affect any stage.
+PARAMETER_STAGES = {"canny_minval": ["eye", "features", "head", "tail"],
+        "canny_maxval": ["eye", "features", "head", "tail"],
+        "find_eye_blur": ["eye"],
+        "find_eye_max_retries": ["eye"],
+        "pyramid_scale": ["eye", "features"],
+        "mask_antenna_blur": ["features"],
+        "roi_padding": ["features"],
+        "edge_pixel_distance_threshold_multiplier": ["features"],
+        "mask_antenna_coronal_tilt": ["features"],
+        "mask_antenna_anterior_tilt": ["features"],
+        "mask_antenna_posterior_tilt": ["features"],
+        "fit_ellipse_chi2": ["features"],
+        "find_head_blur": ["head"],
+        "dorsal_edge_blur": ["dorsal_edge"],
+        "traverse_max_iter": ["dorsal_edge"],
+        "find_tail_blur": ["tail"],
+        "pedestal_n": ["tail"],
+        "count_animal_pixels_blur": [],
+        "count_animal_pixels_n": [],
+        "count_animal_pixels_cc_threshold": [],
+        "analyze_pedestal_moving_avg_window": ["pedestal"],
+        "analyze_pedestal_percentile": ["pedestal"],
+        "analyze_pedestal_polyfit_degree": ["pedestal"]}
+
+# which file the clone is for; stored artifacts are keyed on the image bytes
+# alone, so identical images under different names share them
+IDENTITY_ATTRIBUTES = ("filepath", "filebase")
+
+# image-sized intermediates that are rebuilt from the image, and the work
+# counters (which describe the current run), are not stored
+TRANSIENT_ATTRIBUTES = ("preprocessor", "edges", "edge_copy", "counters")
+
+def stage_keys(image_digest, clone):
+
+    # key for each stage's output: the image plus the values of every
+    # parameter read by that stage or an earlier one
+
+    keys = []
+    used = []
+
+    for stage in STAGE_NAMES:
+        used.extend(sorted([p for p in PARAMETERS if stage in PARAMETER_STAGES.get(p, [])]))
+
+        h = hashlib.sha1()
+        h.update(CACHE_VERSION)
+        h.update(image_digest)
+        h.update(repr([(p, getattr(clone, p)) for p in used]))
+        keys.append(h.hexdigest())
+
+    return keys
+
+def stage_state(clone):
+
+    # adjusted parameters are stored with the stage's output so that
+    # restored clones report the values that were actually used
+
+    return dict([(k, v) for k, v in clone.__dict__.iteritems() if ((k not in PARAMETERS) or (k in ADJUSTED_PARAMETERS)) and (k not in TRANSIENT_ATTRIBUTES) and (k not in IDENTITY_ATTRIBUTES)])
+
+class StageStore(PickleStore):
+
+    # on-disk stage artifacts, one pickle per image digest holding a list of
+    # (stage, key, pickled clone state) for the stages completed so far
+
+    def load(self, image_digest):
+
+        return PickleStore.load(self, image_digest, [])
+
+def run_stages(clone, im, store=None, resume=True, profile=None, image_digest=None):
+
+    # runs the pipeline on clone. With a StageStore, each stage's output is
+    # saved and (if resume) the longest run of stages whose key is unchanged
+    # is restored instead of recomputed. Exceptions propagate after the
+    # completed stages are saved. If a StageProfile is given, each stage that
+    # runs is timed. image_digest is file_digest(clone.filepath), if the
+    # caller has already computed it.
+
+    artifacts = []
+    start = 0
+
+    if store is not None:
+        if image_digest is None:
+            image_digest = file_digest(clone.filepath)
+        keys = stage_keys(image_digest, clone)
+
+        if resume:
+            for stage, key, state in store.load(image_digest):
+                if (start < len(keys)) and (stage == STAGE_NAMES[start]) and (key == keys[start]):
+                    artifacts.append((stage, key, state))
+                    start += 1
+                else:
+                    break
+
+            if start > 0:
+                print "Reusing stages up to " + STAGE_NAMES[start-1]
+                clone.__dict__.update(pickle.loads(artifacts[-1][2]))
+
+                # the pyramid mode's downsampled clone was stored whole
+                coarse = getattr(clone, "coarse", None)
+                if coarse is not None:
+                    for k in IDENTITY_ATTRIBUTES:
+                        setattr(coarse, k, getattr(clone, k))
+
+                if profile is not None:
+                    profile.reused = STAGE_NAMES[0:start]
+
+    try:
+        for i in xrange(start, len(STAGES)):
+            stage, message, steps = STAGES[i]
+
+            if message is not None:
+                print message
+
+            if profile is not None:
+                profile.start(stage)
+
+            for method, takes_image in steps:
+                if takes_image:
+                    getattr(clone, method)(im)
+                else:
+                    getattr(clone, method)()
+
+            if profile is not None:
+                profile.stop(stage)
+
+            if store is not None:
+                artifacts.append((stage, keys[i], pickle.dumps(stage_state(clone), pickle.HIGHEST_PROTOCOL)))
+    finally:
+        if (store is not None) and (len(artifacts) > start):
+            store.save(image_digest, artifacts)
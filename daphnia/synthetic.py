@@ -0,0 +1,132 @@
+from __future__ import division
+import os
+import numpy as np
+import pandas as pd
+import cv2
+
+# synthetic Daphnia and micrometer images with known ground truth, for
+# benchmarks and regression checks that have to run without real data
+#
+# Geometry is laid out for a 1200x1600 image and scaled with the image width.
+# Ground truth points are (row, column), the same convention Clone uses.
+
+def animal_point(center, theta, u, v):
+
+    # (column, row) of the point u along the body axis (towards the tail) and
+    # v across it, for an animal centered at center and rotated by theta
+    # degrees (the same rotation cv2.ellipse uses)
+
+    t = np.deg2rad(theta)
+    return (center[0] + u*np.cos(t) - v*np.sin(t),
+            center[1] + u*np.sin(t) + v*np.cos(t))
+
+def to_row_col(p):
+
+    return (p[1], p[0])
+
+def synthetic_animal(shape=(1200, 1600), theta=10, length_scale=1.0, eye_radius=35, spine_angle=14, antenna=True, noise=1.5, seed=0):
+
+    # returns (image, ground truth dict) for one animal
+
+    rng = np.random.RandomState(seed)
+    h, w = shape
+    s = w/1600
+
+    a, b = 420*s*length_scale, 200*s*length_scale
+    center = (w/2, h/2)
+
+    im = np.full(shape, 200, np.uint8)
+
+    # carapace and outline
+    ellipse_center = (int(round(center[0])), int(round(center[1])))
+    axes = (int(round(a)), int(round(b)))
+    cv2.ellipse(im, ellipse_center, axes, theta, 0, 360, 150, -1)
+    cv2.ellipse(im, ellipse_center, axes, theta, 0, 360, 90, max(1, int(round(6*s))))
+
+    # tail spine, from the posterior end of the carapace
+    spine_length = 257*s*length_scale
+    tail_base = animal_point(center, theta, 0.95*a, 0.35*b)
+    t = np.deg2rad(theta + spine_angle)
+    tail_tip = (tail_base[0] + spine_length*np.cos(t), tail_base[1] + spine_length*np.sin(t))
+    cv2.line(im, tuple(int(round(x)) for x in tail_base), tuple(int(round(x)) for x in tail_tip), 90, max(1, int(round(5*s))))
+
+    # eye
+    r = eye_radius*s*length_scale
+    eye_center = animal_point(center, theta, -0.79*a, -0.2*b)
+    cv2.circle(im, tuple(int(round(x)) for x in eye_center), int(round(r)), 10, -1)
+
+    # antenna
+    if antenna:
+        p1 = animal_point(center, theta, -0.71*a, 0.75*b)
+        p2 = animal_point(center, theta, -1.07*a, 1.6*b)
+        cv2.line(im, tuple(int(round(x)) for x in p1), tuple(int(round(x)) for x in p2), 100, max(1, int(round(4*s))))
+
+    im = np.clip(im + rng.normal(0, noise, shape), 0, 255).astype(np.uint8)
+
+    head = animal_point(center, theta, -a, 0)
+
+    truth = {"animal_x_center": center[1],
+            "animal_y_center": center[0],
+            "eye_x_center": eye_center[1],
+            "eye_y_center": eye_center[0],
+            "eye_area": np.pi*r**2,
+            "head": to_row_col(head),
+            "tail_base": to_row_col(tail_base),
+            "tail_tip": to_row_col(tail_tip),
+            "animal_length": np.linalg.norm(np.array(head) - np.array(tail_base)),
+            "tail_spine_length": spine_length}
+
+    return im, truth
+
+def synthetic_micrometer(shape=(1200, 1600), pixel_to_mm=1104, noise=2, seed=0):
+
+    # returns (image, pixel_to_mm) for a ruler with a tick every 1/40 mm, as
+    # calc_pixel_to_mm expects
+
+    rng = np.random.RandomState(seed)
+    h, w = shape
+    period = pixel_to_mm/40
+
+    im = np.full(shape, 190, np.uint8)
+    for x in np.arange(int(0.125*w), int(0.875*w), period):
+        im[int(0.42*h):int(0.58*h), int(round(x)):int(round(x + period/2))] = 40
+
+    im = np.clip(im + rng.normal(0, noise, shape), 0, 255).astype(np.uint8)
+
+    return im, pixel_to_mm
+
+def synthetic_filebase(i, rig="RigA"):
+
+    # a filename that utils.parse accepts
+    return "full_{0:06d}_D8_{1}_ctrl_1A_{2}_20170601T{3:06d}.bmp".format(100000 + i, i % 1000, rig, i % 240000)
+
+def write_synthetic_set(outdir, n=10, shape=(1200, 1600), seed=0):
+
+    # writes n animals (full_*.bmp), with a micrometer image for each
+    # (fullMicro_*.bmp), into outdir and returns their ground truth, indexed
+    # by filebase. Orientation, size and eye size vary between animals.
+
+    rng = np.random.RandomState(seed)
+
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    rows = []
+    for i in xrange(n):
+        filebase = synthetic_filebase(i)
+
+        im, truth = synthetic_animal(shape,
+                theta=rng.uniform(-15, 15),
+                length_scale=rng.uniform(0.9, 1.1),
+                eye_radius=rng.uniform(30, 40),
+                seed=seed + i)
+        micro, pixel_to_mm = synthetic_micrometer(shape, pixel_to_mm=rng.uniform(1000, 1200), seed=seed + i)
+
+        cv2.imwrite(os.path.join(outdir, filebase), im)
+        cv2.imwrite(os.path.join(outdir, filebase.replace("full", "fullMicro")), micro)
+
+        truth["filebase"] = filebase
+        truth["pixel_to_mm"] = pixel_to_mm
+        rows.append(truth)
+
+    return pd.DataFrame(rows).set_index("filebase")
@@ -1,11 +1,15 @@
 from __future__ import division
-from clone import Clone
+from clone import Clone, PARAMETERS, ADJUSTED_PARAMETERS
+from bmp import imread_grayscale
 import pickle
 import os
+import fcntl
+import glob
+import multiprocessing
 import numpy as np
 import pandas as pd
 import re
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from openpyxl import load_workbook 
 from ast import literal_eval
 import cv2
@@ -19,14 +23,87 @@ def load_pkl(name, path):
     with open(os.path.join(path,name) + '.pkl','rb') as f:
         return pickle.load(f)
 
+def makedirs(path):
+
+    # os.makedirs, but fine if path already exists (e.g. created by another
+    # worker in the meantime)
+
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+def atomic_write(path, write, fsync=False):
+
+    # calls write(f) on a temporary file next to path and renames it into
+    # place, so readers see either the old file or the complete new one. The
+    # temporary name includes the pid so that concurrent writers don't
+    # clobber each other's partial files.
+
+    tmp_path = path + "." + str(os.getpid()) + ".partial"
+    with open(tmp_path, "wb") as f:
+        write(f)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+def atomic_pickle(obj, path):
+
+    atomic_write(path, lambda f: pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL))
+
+def load_pickle(path, default=None):
+
+    # the object pickled at path, or default if it is missing or truncated
+
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        return default
+
+class PickleStore(object):
+
+    # directory of pickles keyed on a hex digest, stored as
+    # <path>/<key[:2]>/<key>.pkl and written atomically, so worker processes
+    # can share one store
+
+    def __init__(self, path):
+
+        self.path = path
+        makedirs(path)
+
+    def entry_path(self, key):
+
+        return os.path.join(self.path, key[:2], key + ".pkl")
+
+    def __contains__(self, key):
+
+        return os.path.isfile(self.entry_path(key))
+
+    def load(self, key, default=None):
+
+        return load_pickle(self.entry_path(key), default)
+
+    def save(self, key, obj):
+
+        path = self.entry_path(key)
+        makedirs(os.path.dirname(path))
+        atomic_pickle(obj, path)
+
+# filename patterns, compiled once
+POND_PATTERN = re.compile('^(A?[DW]?\s?\d{1,2}|Cyril|DBunk|Male|C14|Chard)[\s?|\.?|_?]?(A?\d{1,3}A?)?')
+FILENAME_PATTERN = re.compile('^([A-Za-z]{4,10})_(\d{6})?_?(DBunk_?\s?\d{1,3}|Male_\d|A?[DW]?\s?\d{1,2}[_|\s|.]?A?\d{1,3}A?|Cyril|C14|Chard)_(juju\d?|ctrl|NA|(?:\d*\.)?\d+)_(\d[A-Z]|NA)_(Rig[AB])_(\d{8}T\d{6}).bmp$')
+FILENAME_FIELDS = ["filetype", "barcode", "cloneid", "treatment", "replicate", "rig", "datetime"]
+
 def parsePond(s):
     
     # this method parses clone ids and finds pond name and id
     #
     # if only the pond is given (e.g. Cyrus), the id defaults to pond name
 
-    pattern = '^(A?[DW]?\s?\d{1,2}|Cyril|DBunk|Male|C14|Chard)[\s?|\.?|_?]?(A?\d{1,3}A?)?'
-    m = re.search(pattern, s)
+    m = POND_PATTERN.search(s)
     pond, cloneid = m.groups()
 
     if cloneid is None:
@@ -36,9 +113,7 @@ def parsePond(s):
 
 def parse(s):
 
-    pattern = '^([A-Za-z]{4,10})_(\d{6})?_?(DBunk_?\s?\d{1,3}|Male_\d|A?[DW]?\s?\d{1,2}[_|\s|.]?A?\d{1,3}A?|Cyril|C14|Chard)_(juju\d?|ctrl|NA|(?:\d*\.)?\d+)_(\d[A-Z]|NA)_(Rig[AB])_(\d{8}T\d{6}).bmp$'
-    
-    m = re.search(pattern,s)
+    m = FILENAME_PATTERN.search(s)
     filetype,barcode,cloneid,treatment,replicate,rigId,datetime = m.groups()
     
     return {"filetype":filetype,
@@ -49,7 +124,75 @@ def parse(s):
             "rig":rigId,
             "datetime":datetime}
 
-def build_metadata_dict(filepath, curation_dict, male_list, induction_dict, season_dict, early_release, late_release, duplicate_data, experimenter_data, inducer_data, pixel_to_mm=None):
+def parse_filenames(filenames):
+
+    # parses a list of image filenames (or every file in a directory) in one
+    # pass
+    #
+    # returns a DataFrame indexed by filebase with FILENAME_FIELDS as columns
+    # (datetime parsed, rig categorical, the rest strings or NaN), and the
+    # list of names that didn't match FILENAME_PATTERN
+
+    if isinstance(filenames, basestring):
+        filenames = os.listdir(filenames)
+
+    filebases = pd.Series([os.path.basename(f) for f in filenames], dtype=object)
+
+    df = filebases.str.extract(FILENAME_PATTERN.pattern, expand=True)
+    df.columns = FILENAME_FIELDS
+    df.index = filebases.values
+    df.index.name = "filebase"
+
+    matched = df["filetype"].notnull().values
+    unparsed = list(filebases[~matched])
+
+    df = df[matched].copy()
+    df["datetime"] = pd.to_datetime(df["datetime"], format="%Y%m%dT%H%M%S")
+    df["rig"] = df["rig"].astype("category")
+
+    return df, unparsed
+
+def micrometer_needed(filepath, pixel_to_mm=None, calibration=None, sessions=None):
+
+    # whether build_metadata_dict, given the same pixel_to_mm and
+    # calibration, will measure filepath's micrometer image
+    #
+    # sessions is a set of calibration session keys whose micrometer image is
+    # already going to be measured; it's updated, so that later images from
+    # those sessions don't read theirs.
+
+    if pixel_to_mm is not None:
+        return False
+
+    micro_filepath = filepath.replace("full","fullMicro")
+    if not os.path.isfile(micro_filepath):
+        return False
+
+    if calibration is None:
+        return True
+
+    rig, date = None, None
+    m = FILENAME_PATTERN.search(os.path.basename(filepath))
+    if m is not None:
+        rig, date = m.group(6), m.group(7)[0:8]
+
+    if calibration.resolved(micro_filepath, rig, date):
+        return False
+
+    session_key = calibration.session_key(rig, date)
+    if session_key is not None:
+        if (sessions is not None) and (session_key in sessions):
+            return False
+        if sessions is not None:
+            sessions.add(session_key)
+
+    return True
+
+def build_metadata_dict(filepath, curation_dict, male_list, induction_dict, season_dict, early_release, late_release, duplicate_data, experimenter_data, inducer_data, pixel_to_mm=None, calibration=None, micro_im=None):
+
+    # calibration is an optional CalibrationRegistry used to look up
+    # pixel_to_mm instead of measuring the micrometer image every time.
+    # micro_im is the micrometer image, if it has already been read.
 
     _, filebase = os.path.split(filepath)
     md = parse(filebase)
@@ -65,8 +208,13 @@ def build_metadata_dict(filepath, curation_dict, male_list, induction_dict, seas
     
     if pixel_to_mm is None:
         try:
-            im = cv2.imread(filepath.replace("full","fullMicro"), cv2.IMREAD_GRAYSCALE)
-            md['pixel_to_mm'] = calc_pixel_to_mm(im)
+            micro_filepath = filepath.replace("full","fullMicro")
+            if calibration is not None:
+                md['pixel_to_mm'] = calibration.scale(micro_filepath, md['rig'], md['datetime'][0:8], micro_im)
+            else:
+                if micro_im is None:
+                    micro_im = imread_grayscale(micro_filepath)
+                md['pixel_to_mm'] = calc_pixel_to_mm(micro_im)
         except Exception as e:
             print "Error extracting conversion factor from micrometer: " + str(e)
             md['pixel_to_mm'] = np.nan
@@ -142,26 +290,47 @@ def recursivedict():
 
     return defaultdict(recursivedict)
 
-def load_induction_data(filepath):
+def induction_files(filepath):
+
+    return [os.path.join(filepath, i) for i in os.listdir(filepath) if not i.startswith("._") and (i.endswith(".xlsx") or i.endswith(".xls"))]
+
+def load_induction_workbook(path):
+
+    # returns barcode -> induction date for one induction workbook
+
+    print "Loading " + os.path.basename(path)
+    wb = load_workbook(path, data_only=True)
+    data = wb["Inductions"].values
+    cols = next(data)[0:]
+    data = list(data)
+    df = pd.DataFrame(data, columns=cols)
+    df = df[df.ID_Number.notnull()]
+    df = df[[not str(i) == "NaT" for i in df['ID_Number']]]
+
+    return dict(zip([str(int(i)) for i in df['ID_Number']],
+        [pd.Timestamp(t).strftime("%Y%m%dT%H%M%S") for t in df['Induction_Date']]))
+
+def load_induction_data(filepath, jobs=1):
     
+    # workbooks are parsed in a pool of jobs processes if jobs > 1; later
+    # files still take precedence, in directory listing order
+
     print "Loading induction data\n"
+    inductionfiles = induction_files(filepath)
+
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            workbooks = pool.map(load_induction_workbook, inductionfiles)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        workbooks = [load_induction_workbook(i) for i in inductionfiles]
+    
     inductiondates = {}
-    inductionfiles = os.listdir(filepath)
-
-    for i in inductionfiles:
-        if not i.startswith("._") and (i.endswith(".xlsx") or i.endswith(".xls")):
-            print "Loading " + i
-            wb = load_workbook(os.path.join(filepath,i), data_only=True)
-            data = wb["Inductions"].values
-            cols = next(data)[0:]
-            data = list(data)
-	    df = pd.DataFrame(data, columns=cols)
-            df = df[df.ID_Number.notnull()]
-
-            for j,row in df.iterrows():
-                if not str(row['ID_Number']) == "NaT":
-                    time = pd.Timestamp(row['Induction_Date'])
-                    inductiondates[str(int(row['ID_Number']))] = time.strftime("%Y%m%dT%H%M%S")
+    for wb in workbooks:
+        inductiondates.update(wb)
 
     return inductiondates
 
@@ -169,13 +338,9 @@ def load_pond_season_data(filepath):
 
     print "Loading pond and season metadata\n"
     df = pd.read_csv( filepath )
+    df = df.drop_duplicates('cloneid', keep='last')
 
-    pond_season_dict = {}
-
-    for i, row in df.iterrows():
-        pond_season_dict[row['cloneid']] = {'pond':row['pond'], 'id':row['id'], 'season':row['season']}
-
-    return pond_season_dict
+    return dict(zip(df['cloneid'], df[['pond', 'id', 'season']].to_dict('records')))
 
 def load_manual_scales(filepath):
 
@@ -190,6 +355,169 @@ def load_manual_scales(filepath):
     
     return manual_scales
 
+class CalibrationRegistry(object):
+
+    # pixel_to_mm scales, computed once per micrometer image and reused
+    #
+    # Scales are keyed by micrometer file (path, mtime and size). With
+    # by_session, they are also keyed by (rig, date), so that every image from
+    # a session shares the first micrometer measurement. manual_scales
+    # (micrometer filename -> scale, as returned by load_manual_scales)
+    # override computed scales. If path is given, the registry is kept there
+    # as a pickle.
+
+    def __init__(self, path=None, manual_scales=None, by_session=False):
+
+        self.path = path
+        self.by_session = by_session
+        self.manual_scales = {}
+        self.scales = {}
+
+        if manual_scales is not None:
+            for filename, conversion in manual_scales.iteritems():
+                self.manual_scales[filename] = float(conversion)
+
+        if (path is not None) and os.path.isfile(path):
+            self.scales = self.load()
+
+    def load(self):
+
+        return load_pickle(self.path, {})
+
+    def save(self):
+
+        # merge with entries other processes may have saved in the meantime.
+        # Workers each hold a copy of the registry, so the load, merge and
+        # rename happen under an exclusive lock; otherwise two workers saving
+        # at once would each drop the other's new entries.
+        with open(self.path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            scales = self.load()
+            scales.update(self.scales)
+            self.scales = scales
+
+            atomic_pickle(scales, self.path)
+
+    def file_key(self, micro_filepath):
+
+        st = os.stat(micro_filepath)
+        return ("file", os.path.abspath(micro_filepath), st.st_mtime, st.st_size)
+
+    def session_key(self, rig=None, date=None):
+
+        if self.by_session and (rig is not None) and (date is not None):
+            return ("session", rig, date)
+        return None
+
+    def resolved(self, micro_filepath, rig=None, date=None):
+
+        # whether scale() can answer without measuring the micrometer image
+
+        for name in [micro_filepath, os.path.basename(micro_filepath)]:
+            if name in self.manual_scales:
+                return True
+
+        if self.session_key(rig, date) in self.scales:
+            return True
+
+        return self.file_key(micro_filepath) in self.scales
+
+    def scale(self, micro_filepath, rig=None, date=None, im=None):
+
+        # im is the micrometer image, if it has already been read
+
+        for name in [micro_filepath, os.path.basename(micro_filepath)]:
+            if name in self.manual_scales:
+                return self.manual_scales[name]
+
+        session_key = self.session_key(rig, date)
+        if session_key in self.scales:
+            return self.scales[session_key]
+
+        file_key = self.file_key(micro_filepath)
+        updated = False
+
+        if file_key not in self.scales:
+            if im is None:
+                im = imread_grayscale(micro_filepath)
+            self.scales[file_key] = calc_pixel_to_mm(im)
+            updated = True
+
+        scale = self.scales[file_key]
+
+        if session_key is not None:
+            self.scales[session_key] = scale
+            updated = True
+
+        if updated and (self.path is not None):
+            self.save()
+
+        return scale
+
+def source_signature(paths):
+
+    # (path, mtime, size) for each file, used to tell when a snapshot is stale
+
+    signature = []
+    for path in paths:
+        st = os.stat(path)
+        signature.append((os.path.abspath(path), st.st_mtime, st.st_size))
+
+    return signature
+
+def load_metadata_snapshot(snapshot_path, induction_dir, pond_season_csvpath, curation_csvpath, experimenter_csvpath, jobs=1):
+
+    # returns (curation_data, induction_dates, season_data, experimenter_data,
+    # inducer_data), read from a pickled snapshot if none of the source files
+    # (or the set of induction workbooks) changed since it was written, and
+    # otherwise rebuilt and saved
+
+    sources = [pond_season_csvpath, curation_csvpath, experimenter_csvpath] + sorted(induction_files(induction_dir))
+    signature = source_signature(sources)
+
+    snapshot = load_pickle(snapshot_path)
+    if (snapshot is not None) and (snapshot.get("signature") == signature):
+        print "Loading metadata snapshot\n"
+        return snapshot["data"]
+
+    experimenter_data, inducer_data = load_experimenter_data(experimenter_csvpath)
+    data = (load_manual_curation(curation_csvpath),
+            load_induction_data(induction_dir, jobs),
+            load_pond_season_data(pond_season_csvpath),
+            experimenter_data,
+            inducer_data)
+
+    atomic_pickle({"signature": signature, "data": data}, snapshot_path)
+
+    return data
+
+def load_metadata_sources(params, jobs=1):
+
+    # returns the metadata tables in the order build_metadata_dict takes them
+    #
+    # If params has metadata_snapshot, the curation, induction, season and
+    # experimenter tables come from (or are compiled into) that snapshot.
+
+    if params.get('metadata_snapshot'):
+        curation_data, induction_dates, season_data, experimenter_data, inducer_data = load_metadata_snapshot(params['metadata_snapshot'],
+                params['induction_csvpath'],
+                params['pond_season_csvpath'],
+                params['curation_csvpath'],
+                params['experimenter_csvpath'],
+                jobs)
+    else:
+        curation_data = load_manual_curation(params['curation_csvpath'])
+        induction_dates = load_induction_data(params['induction_csvpath'], jobs)
+        season_data = load_pond_season_data(params['pond_season_csvpath'])
+        experimenter_data, inducer_data = load_experimenter_data(params['experimenter_csvpath'])
+
+    males_list = load_male_list(params['male_listpath'])
+    early_release = load_release_data(params['early_release_csvpath'])
+    late_release = load_release_data(params['late_release_csvpath'])
+    duplicate_data = load_duplicate_data(params['duplicate_csvpath'])
+
+    return (curation_data, males_list, induction_dates, season_data, early_release, late_release, duplicate_data, experimenter_data, inducer_data)
+
 def load_release_data(filepath):
     
     with open(filepath, "rb") as f:
@@ -199,14 +527,9 @@ def load_release_data(filepath):
 
 def load_duplicate_data(filepath):
 
-    duplicate_dict = {}
-
     df = pd.read_csv(filepath, index_col="filebase")
 
-    for i, row in df.iterrows():
-        duplicate_dict["full_"+i] = row['Notes']
-
-    return duplicate_dict
+    return dict(zip(["full_" + i for i in df.index], df['Notes']))
 
 def build_clonelist(datadir, analysisdir, inductiondatadir, pondseasondir, ext=".bmp"):
     
@@ -338,24 +661,20 @@ def load_male_list(csvpath):
 
 def load_manual_curation(csvpath):
 
-    df = pd.read_csv(csvpath)
-    
-    curation_data = {}
+    # filebase -> {manual_PF, manual_PF_reason, manual_PF_curator}
 
-    for i, row in df.iterrows():
-        curation_data[row['filebase'] + ".bmp"] = row
+    df = pd.read_csv(csvpath)
+    df = df.drop_duplicates('filebase', keep='last')
     
-    return curation_data
+    return dict(zip(df['filebase'] + ".bmp", df[['manual_PF', 'manual_PF_reason', 'manual_PF_curator']].to_dict('records')))
 
 def load_experimenter_data(csvpath):
 
     df = pd.read_csv(csvpath)
-    experimenter_data = {}
-    inducer_data = {}
+    keys = zip([str(b) for b in df['Barcode']], [str(d) for d in df['Date']])
 
-    for i, row in df.iterrows():
-        experimenter_data[(str(row['Barcode']),str(row['Date']))] = row['Initials']
-        inducer_data[(str(row['Barcode']),str(row['Date']))] = row['Inductions']
+    experimenter_data = dict(zip(keys, df['Initials']))
+    inducer_data = dict(zip(keys, df['Inductions']))
     return experimenter_data, inducer_data
 
 def crop(img):
@@ -606,6 +925,110 @@ def clone_to_line(clone, cols, metadata_fields=None, metadata=None):
 
     return "\t".join(tmpdata)
 
+SHAPE_COLS = ["filebase","i","x","y","qi","q","checkpoint"]
+
+def clone_values(clone, cols, metadata_fields, metadata):
+
+    # returns the output values for a clone (raises AttributeError if a column is missing)
+
+    values = []
+    for mf in metadata_fields:
+        
+        try:
+            if mf == "animal_dorsal_area_mm":
+                val = getattr(clone, "animal_dorsal_area")/np.power(metadata["pixel_to_mm"], 2)
+            elif mf == "eye_area_mm":
+                val = getattr(clone, "eye_area")/np.power(metadata["pixel_to_mm"], 2)
+            elif mf == "animal_length_mm":
+                val = getattr(clone, "animal_length")/metadata["pixel_to_mm"]
+            elif mf == "tail_spine_length_mm":
+                val = getattr(clone, "tail_spine_length")/metadata["pixel_to_mm"]
+            elif mf == "pedestal_area_mm":
+                val = getattr(clone, "pedestal_area")/np.power(metadata["pixel_to_mm"], 2)
+            elif mf == "pedestal_max_height_mm":
+                val = getattr(clone, "pedestal_max_height")/metadata["pixel_to_mm"]
+            elif mf == "deyecenter_pedestalmax_mm":
+                val = getattr(clone, "deyecenter_pedestalmax")/metadata["pixel_to_mm"]
+            else:
+                val = metadata[mf]
+        except Exception:
+            val = np.nan
+        
+        values.append(val)
+
+    for c in cols:
+        values.append(getattr(clone, c))
+    
+    return values
+
+def clone_row(clone, cols, metadata_fields, metadata):
+
+    # returns the output line for a clone (raises AttributeError if a column is missing)
+
+    return "\t".join([str(val) for val in clone_values(clone, cols, metadata_fields, metadata)])
+
+def point_keys(points):
+
+    # encodes each (x, y) row as one complex number so that rows can be
+    # matched with a single np.in1d call
+
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    return points[:,0] + 1j*points[:,1]
+
+def checkpoint_flags(clone):
+
+    # 1 for each dorsal edge point that is also a checkpoint, otherwise 0
+
+    return np.in1d(point_keys(clone.dorsal_edge), point_keys(clone.checkpoints)).astype(int)
+
+def shape_rows(clone):
+
+    # returns the output lines for the dorsal edge of a clone
+
+    n = len(clone.dorsal_edge)
+    if (len(clone.qi) < n) or (len(clone.q) < n):
+        raise IndexError("qi/q shorter than dorsal edge")
+
+    checkpoint = checkpoint_flags(clone)
+
+    return ['\t'.join([clone.filebase, str(i), str(x), str(y), str(qi), str(q), str(c)])
+            for i, x, y, qi, q, c in zip(range(n), clone.dorsal_edge[:,0], clone.dorsal_edge[:,1], clone.qi, clone.q, checkpoint)]
+
+def shape_columns(clone):
+
+    # returns the dorsal edge of a clone as typed columns
+
+    de = np.asarray(clone.dorsal_edge, dtype=float)
+    i = np.arange(len(de))
+
+    return {"filebase": np.array([clone.filebase]*len(de)),
+            "i": i,
+            "x": de[:,0],
+            "y": de[:,1],
+            "qi": np.asarray(clone.qi, dtype=float)[i],
+            "q": np.asarray(clone.q, dtype=float)[i],
+            "checkpoint": checkpoint_flags(clone).astype(np.int8)}
+
+def analysis_metadata_row(clone, params_dict):
+
+    # returns the parameter names and values used for the clone: adjusted
+    # parameters from the clone, the rest from the run's params_dict
+
+    params_key_list = [] 
+    params_val_list = []
+
+    for k in params_dict.keys():
+       try:
+           if (k in PARAMETERS) and (k not in ADJUSTED_PARAMETERS):
+               params_val_list.append(str(params_dict[k]))
+           else:
+               params_val_list.append(str(getattr(clone,k)))
+           params_key_list.append(k)
+       except AttributeError:
+           continue
+
+    return params_key_list, params_val_list
+
 def write_clone(clone, cols, metadata_fields, metadata, output, shape_output):
 
     try:
@@ -628,65 +1051,366 @@ def write_clone(clone, cols, metadata_fields, metadata, output, shape_output):
 
         try:
             with open(shape_output, "wb+") as f:
-                f.write( "\t".join(["filebase","i","x","y","qi","q","checkpoint"]) + "\n")
+                f.write( "\t".join(SHAPE_COLS) + "\n")
         except IOError:
             print "Can't find desired location for saving data"
     
     try:
+        line = clone_row(clone, cols, metadata_fields, metadata)
+
         with open(output, "ab+") as f:
+            f.write(line + "\n")
+        
+        try:
+            rows = shape_rows(clone)
+            with open(shape_output, "ab+") as f:
+                f.write("".join(row + "\n" for row in rows))
+        
+        except Exception as e:
+            print "Error writing dorsal edge to file: " + str(e)
+    except (IOError, AttributeError) as e:
+        print "Can't write data for " + clone.filepath + " to file: " + str(e)
 
-            tmpdata = []
-            for mf in metadata_fields:
-                
-                try:
-                    if mf == "animal_dorsal_area_mm":
-                        val = getattr(clone, "animal_dorsal_area")/np.power(metadata["pixel_to_mm"], 2)
-                    elif mf == "eye_area_mm":
-                        val = getattr(clone, "eye_area")/np.power(metadata["pixel_to_mm"], 2)
-                    elif mf == "animal_length_mm":
-                        val = getattr(clone, "animal_length")/metadata["pixel_to_mm"]
-                    elif mf == "tail_spine_length_mm":
-                        val = getattr(clone, "tail_spine_length")/metadata["pixel_to_mm"]
-                    elif mf == "pedestal_area_mm":
-                        val = getattr(clone, "pedestal_area")/np.power(metadata["pixel_to_mm"], 2)
-                    elif mf == "pedestal_max_height_mm":
-                        val = getattr(clone, "pedestal_max_height")/metadata["pixel_to_mm"]
-                    elif mf == "deyecenter_pedestalmax_mm":
-                        val = getattr(clone, "deyecenter_pedestalmax")/metadata["pixel_to_mm"]
-                    else:
-                        val = metadata[mf]
-                except Exception:
-                    val = "nan"
-                
-                tmpdata.append(str(val))
+class TableWriter(object):
 
+    # tab-separated output file that is opened once per run
+    #
+    # Rows are buffered and appended in blocks of flush_rows. The length of
+    # the file after each block is kept in a ".committed" file next to path;
+    # a run that dies leaves that file behind, and the next run truncates
+    # path back to the recorded length before appending, which only drops a
+    # block cut off part way through. commit() also fsyncs. Nothing that was
+    # already in path is rewritten.
 
+    def __init__(self, path, header, flush_rows=1000):
 
-            for c in cols:
+        self.path = path
+        self.offset_path = path + ".committed"
+        self.flush_rows = flush_rows
+        self.buffer = []
 
-                val = str(getattr(clone, c))
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            size = 0
+
+        # rows past the offset recorded by an interrupted run were never
+        # committed
+        committed = self.read_offset()
+        if (committed is not None) and (committed < size):
+            with open(path, "r+b") as f:
+                f.truncate(committed)
+            size = committed
+
+        new = (size == 0)
+
+        self.f = open(path, "ab")
+        if new:
+            self.f.write("\t".join(header) + "\n")
+
+        self.new = new
+        self.commit()
+
+    def read_offset(self):
 
-                if val is not None:
-                    tmpdata.append(val)
-                else:
-                    tmpdata.append("nan")
-            
-            f.write("\t".join(tmpdata) + "\n")
-        
         try:
-            with open(shape_output, "ab+") as f:
-                for i in np.arange(len(clone.dorsal_edge)):
+            with open(self.offset_path, "rb") as f:
+                return int(f.read())
+        except (IOError, ValueError):
+            return None
+
+    def write_offset(self, offset):
+
+        atomic_write(self.offset_path, lambda f: f.write(str(offset)), fsync=True)
+
+    def write(self, rows):
+
+        self.buffer.extend(rows)
+        if len(self.buffer) >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+
+        if len(self.buffer) > 0:
+            self.f.write("\n".join(self.buffer) + "\n")
+            self.buffer = []
+            self.f.flush()
+            self.write_offset(self.f.tell())
+        else:
+            self.f.flush()
 
-                    if len(np.where((clone.checkpoints==clone.dorsal_edge[i,:]).all(axis=1))[0]) > 0:
-                        checkpoint = 1
-                    else:
-                        checkpoint = 0
-                    f.write('\t'.join([clone.filebase, str(i), str(clone.dorsal_edge[i, 0]), str(clone.dorsal_edge[i,1]), str(clone.qi[i]), str(clone.q[i]), str(checkpoint)]) + "\n")
+    def commit(self):
         
-        except Exception as e:
-            print "Error writing dorsal edge to file: " + str(e)
-    except (IOError, AttributeError) as e:
-        print "Can't write data for " + clone.filepath + " to file: " + str(e)
+        self.flush()
+        os.fsync(self.f.fileno())
+        self.write_offset(self.f.tell())
+
+    def checkpoint(self):
+
+        self.commit()
+
+    def close(self):
+
+        if not self.f.closed:
+            self.flush()
+            os.fsync(self.f.fileno())
+            self.f.close()
+            # a clean close leaves nothing to recover
+            if os.path.isfile(self.offset_path):
+                os.remove(self.offset_path)
+
+# output columns kept as strings in columnar output even when every value
+# looks like a number (IDs, labels and notes)
+TEXT_COLS = ["filepath",
+        "filebase",
+        "modification_notes",
+        "modifier",
+        "automated_PF",
+        "automated_PF_reason"]
+
+# metadata fields that are measurements; every other metadata field is text
+NUMERIC_METADATA_FIELDS = ["pixel_to_mm",
+        "animal_dorsal_area_mm",
+        "animal_length_mm",
+        "eye_area_mm",
+        "tail_spine_length_mm",
+        "deyecenter_pedestalmax_mm",
+        "pedestal_area_mm",
+        "pedestal_max_height_mm"]
+
+def text_columns(cols, metadata_fields):
+
+    return [mf for mf in metadata_fields if mf not in NUMERIC_METADATA_FIELDS] + [c for c in cols if c in TEXT_COLS]
+
+def columnar_array(values, text=False):
+
+    # converts a list of output values to a typed column: numbers become a
+    # float array, points and coefficients a nan-padded 2-D float array, and
+    # anything else (or any text column) a string array
+
+    if text:
+        return np.array([str(val) for val in values])
+
+    try:
+        arrays = [np.asarray(val, dtype=float) for val in values]
+    except (TypeError, ValueError):
+        return np.array([str(val) for val in values])
+
+    if all([a.ndim == 0 for a in arrays]):
+        return np.array(arrays, dtype=float)
+
+    if any([a.ndim > 1 for a in arrays]):
+        return np.array([str(val) for val in values])
+
+    width = max([a.size for a in arrays if a.ndim == 1])
+    column = np.full((len(arrays), width), np.nan)
+    for i, a in enumerate(arrays):
+        if a.ndim == 1:
+            column[i, :a.size] = a
+
+    return column
+
+def concatenate_columns(parts, text=False):
+
+    if text:
+        parts = [part.astype(str) for part in parts]
+
+    try:
+        return np.concatenate(parts)
+    except ValueError:
+        # e.g. point columns of different widths
+        return columnar_array([val for part in parts for val in part], text)
+
+class ColumnarWriter(object):
+
+    # NPZ output holding one typed array per column
+    #
+    # Rows (write_row) or blocks of columns (write_block) are kept in memory.
+    # Each checkpoint writes only the rows since the last one, as a shard
+    # next to path (path + ".shard00000" and so on), and close merges the
+    # existing file, the shards and the remaining rows into path atomically.
+    # Shards left behind by a run that didn't close are picked up by the
+    # next one. Columns in text_columns are always stored as strings. An
+    # existing file or shard with different columns raises ValueError rather
+    # than being merged out of line.
+
+    def __init__(self, path, columns, text_columns=()):
+
+        self.path = path
+        self.columns = list(columns)
+        self.text_columns = set(text_columns)
+        self.reset()
+
+        self.new = not os.path.isfile(path)
+
+        prefix = path + ".shard"
+        self.shards = sorted([p for p in glob.glob(prefix + "*") if p[len(prefix):].isdigit()])
+
+        for stored in ([] if self.new else [path]) + self.shards:
+            if columnar_columns(stored) != self.columns:
+                raise ValueError("Columns of " + stored + " don't match this run's; write to a new columnar output")
+
+    def reset(self):
+
+        self.values = dict((c, []) for c in self.columns)
+        self.blocks = dict((c, []) for c in self.columns)
+
+    def write_row(self, values):
+
+        for c, val in zip(self.columns, values):
+            self.values[c].append(val)
+
+    def write_block(self, block):
+
+        for c in self.columns:
+            self.blocks[c].append(np.asarray(block[c]))
+
+    def pending(self, c):
+
+        parts = []
+        if len(self.values[c]) > 0:
+            parts.append(columnar_array(self.values[c], c in self.text_columns))
+        parts.extend(self.blocks[c])
+        return parts
+
+    def save(self, path, data):
+
+        data["__columns__"] = np.array(self.columns)
+
+        atomic_write(path, lambda f: np.savez(f, **data), fsync=True)
+
+    def checkpoint(self):
+
+        # writes the rows since the last checkpoint as a new shard
+        if all([len(self.pending(c)) == 0 for c in self.columns]):
+            return
+
+        shard = "{0}.shard{1:05d}".format(self.path, len(self.shards))
+        self.save(shard, dict((c, concatenate_columns(self.pending(c), c in self.text_columns)) for c in self.columns))
+
+        self.shards.append(shard)
+        self.reset()
+
+    def close(self):
+
+        stored = [load_columnar(shard) for shard in self.shards]
+        if not self.new:
+            stored.insert(0, load_columnar(self.path))
+
+        data = {}
+        for c in self.columns:
+            parts = [part[c] for part in stored if c in part] + self.pending(c)
+            if len(parts) == 0:
+                data[c] = np.array([])
+            else:
+                data[c] = concatenate_columns(parts, c in self.text_columns)
+
+        self.save(self.path, data)
+
+        for shard in self.shards:
+            os.remove(shard)
+        self.shards = []
+        self.new = False
+        self.reset()
+
+def columnar_columns(path):
+
+    with np.load(path) as data:
+        return [str(c) for c in data["__columns__"]]
+
+def load_columnar(path):
+
+    # returns the columns of an NPZ output file, in their original order
+
+    with np.load(path) as data:
+        columns = [str(c) for c in data["__columns__"]]
+        return OrderedDict((c, data[c]) for c in columns)
+
+def read_shape_columnar(shape_file):
+
+    return pd.DataFrame(load_columnar(shape_file))
+
+class ResultWriter(object):
+
+    # owns the clone, shape and analysis metadata outputs for a run
+    #
+    # Every clone's rows are buffered together, and all outputs are committed
+    # every checkpoint_clones clones (0 means only on close), so a run that
+    # is killed loses at most the clones since the last checkpoint. If columnar
+    # output paths are given, the same tables are also written as NPZ.
+
+    def __init__(self, output, shape_output, metadata_output=None, flush_rows=1000, checkpoint_clones=10, columnar_output=None, columnar_shape_output=None):
+
+        self.output = output
+        self.shape_output = shape_output
+        self.metadata_output = metadata_output
+        self.columnar_output = columnar_output
+        self.columnar_shape_output = columnar_shape_output
+        self.flush_rows = flush_rows
+        self.checkpoint_clones = checkpoint_clones
+
+        # writers are opened when the first clone arrives, since the headers
+        # depend on the metadata fields and parameters
+        self.writers = {}
+        self.n_clones = 0
+
+    def open_writer(self, key, path, header, message):
+
+        if key not in self.writers:
+            self.writers[key] = TableWriter(path, header, self.flush_rows)
+            if self.writers[key].new:
+                print message
+        
+        return self.writers[key]
+
+    def open_columnar_writer(self, key, path, columns, text_columns=()):
+
+        if (path is not None) and (key not in self.writers):
+            self.writers[key] = ColumnarWriter(path, columns, text_columns)
+
+        return self.writers.get(key)
+
+    def write_clone(self, clone, cols, metadata_fields, metadata, params_dict=None):
+
+        out = self.open_writer("output", self.output, list(metadata_fields) + list(cols), "Starting new output file")
+        shape_out = self.open_writer("shape_output", self.shape_output, SHAPE_COLS, "Starting new pedestal output file")
+
+        columnar_out = self.open_columnar_writer("columnar_output", self.columnar_output, list(metadata_fields) + list(cols), text_columns(cols, metadata_fields))
+        columnar_shape_out = self.open_columnar_writer("columnar_shape_output", self.columnar_shape_output, SHAPE_COLS, ["filebase"])
+
+        try:
+            values = clone_values(clone, cols, metadata_fields, metadata)
+            out.write(["\t".join([str(val) for val in values])])
+            if columnar_out is not None:
+                columnar_out.write_row(values)
+
+            try:
+                shape_out.write(shape_rows(clone))
+                if columnar_shape_out is not None:
+                    columnar_shape_out.write_block(shape_columns(clone))
+            except Exception as e:
+                print "Error writing dorsal edge to file: " + str(e)
+        except (IOError, AttributeError) as e:
+            print "Can't write data for " + clone.filepath + " to file: " + str(e)
+
+        if (params_dict is not None) and (self.metadata_output is not None):
+            keys, vals = analysis_metadata_row(clone, params_dict)
+            meta_out = self.open_writer("metadata_output", self.metadata_output, keys, "Starting new analysis metadata output file")
+            meta_out.write(["\t".join(vals)])
+
+        self.n_clones += 1
+        if self.checkpoint_clones and (self.n_clones % self.checkpoint_clones == 0):
+            self.checkpoint()
+
+    def checkpoint(self):
+
+        for writer in self.writers.values():
+            writer.checkpoint()
+
+    def close(self):
+
+        for writer in self.writers.values():
+            writer.close()
 
 def read_shape_long( shape_file ):
 
@@ -716,15 +1440,8 @@ def read_masked_regions_long( masked_regions_file ):
 
 def write_analysis_metadata(clone, params_dict, metadata_output_file):
     
-    params_key_list = [] 
-    params_val_list = []
+    params_key_list, params_val_list = analysis_metadata_row(clone, params_dict)
 
-    for k in params_dict.keys():
-       try:
-           params_val_list.append(str(getattr(clone,k)))
-           params_key_list.append(k)
-       except AttributeError:
-           continue
     try:
         if (os.stat(metadata_output_file).st_size == 0):
             raise OSError
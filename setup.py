@@ -15,5 +15,7 @@ setup(
         entry_points='''
             [console_scripts]
             daphnia=daphnia.scripts.run_daphnia:daphnia
+            daphnia_benchmark=daphnia.scripts.benchmark:benchmark
+            daphnia_regress=daphnia.scripts.regress:regress
         ''',
 )
@@ -0,0 +1,37 @@
+import os
+import pytest
+from daphnia.clone import Clone
+from daphnia.bmp import imread_grayscale
+from daphnia.stages import run_stages
+from daphnia.synthetic import write_synthetic_set
+from daphnia.scripts.benchmark import BENCHMARK_PARAMS
+
+@pytest.fixture(scope="session")
+def synthetic_set(tmpdir_factory):
+
+    # (directory, ground truth) for a small set of synthetic animals
+
+    outdir = str(tmpdir_factory.mktemp("synthetic"))
+    truth = write_synthetic_set(outdir, n=8)
+    return outdir, truth
+
+@pytest.fixture
+def params():
+
+    return dict(BENCHMARK_PARAMS)
+
+def synthetic_images(synthetic_set):
+
+    outdir, truth = synthetic_set
+    return [os.path.join(outdir, filebase) for filebase in truth.index]
+
+def analyze(filepath, params, **overrides):
+
+    # runs the pipeline on one image with params updated by overrides
+
+    params = dict(params)
+    params.update(overrides)
+
+    clone = Clone(filepath, **params)
+    run_stages(clone, imread_grayscale(filepath))
+    return clone
@@ -0,0 +1,18 @@
+import numpy as np
+from conftest import synthetic_images, analyze
+
+LANDMARKS = ["head", "tail", "tail_dorsal", "tail_base", "tail_tip", "eye_dorsal"]
+
+def test_pyramid_matches_full_resolution(synthetic_set, params):
+
+    for filepath in synthetic_images(synthetic_set):
+        full = analyze(filepath, params)
+        pyramid = analyze(filepath, params, pyramid_scale=2)
+
+        for landmark in LANDMARKS:
+            assert np.max(np.abs(np.subtract(getattr(pyramid, landmark), getattr(full, landmark)))) <= 1, landmark
+
+        assert abs(pyramid.eye_area - full.eye_area) <= 0.01*full.eye_area
+        assert abs(pyramid.animal_length - full.animal_length) <= 1
+        assert abs(pyramid.dorsal_residual - full.dorsal_residual) <= 0.005*full.dorsal_residual
+        assert pyramid.automated_PF == full.automated_PF
@@ -0,0 +1,20 @@
+import numpy as np
+from conftest import synthetic_images, analyze
+
+LANDMARKS = ["head", "tail", "tail_dorsal", "tail_base", "tail_tip"]
+
+def test_roi_matches_whole_image(synthetic_set, params):
+
+    # find_edge2 thresholds on the edge pixels it is given, so the region's
+    # picks can move a few pixels from the whole image's
+    for filepath in synthetic_images(synthetic_set):
+        whole = analyze(filepath, params, roi_padding=None)
+        cropped = analyze(filepath, params, roi_padding=100)
+
+        assert cropped.roi is not None
+        for landmark in LANDMARKS:
+            assert np.max(np.abs(np.subtract(getattr(cropped, landmark), getattr(whole, landmark)))) <= 4, landmark
+
+        assert abs(cropped.animal_length - whole.animal_length) <= 1
+        assert abs(cropped.dorsal_residual - whole.dorsal_residual) <= 0.005*whole.dorsal_residual
+        assert cropped.automated_PF == whole.automated_PF
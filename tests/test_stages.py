@@ -0,0 +1,32 @@
+import os
+import shutil
+from daphnia.clone import Clone
+from daphnia.bmp import imread_grayscale
+from daphnia.stages import StageStore, run_stages
+from conftest import synthetic_images
+
+def test_identical_images_keep_their_own_names(synthetic_set, params, tmpdir):
+
+    # the stage store is keyed on the image bytes, so the second copy is
+    # restored from the first one's artifacts
+
+    image = synthetic_images(synthetic_set)[0]
+    first = str(tmpdir.join("full_copy_a.bmp"))
+    second = str(tmpdir.join("full_copy_b.bmp"))
+    shutil.copyfile(image, first)
+    shutil.copyfile(image, second)
+
+    store = StageStore(str(tmpdir.join("artifacts")))
+
+    clones = []
+    for filepath in [first, second]:
+        clone = Clone(filepath, **params)
+        run_stages(clone, imread_grayscale(filepath), store)
+        clones.append(clone)
+
+    a, b = clones
+    assert b.filepath == second
+    assert b.filebase == os.path.basename(second)
+    assert b.result().filepath == second
+    assert a.filepath == first
+    assert b.animal_length == a.animal_length
@@ -0,0 +1,24 @@
+import daphnia.utils as utils
+from daphnia.synthetic import synthetic_filebase
+
+def test_parse_filenames_matches_parse():
+
+    filebases = [synthetic_filebase(i) for i in xrange(3)]
+    df, unparsed = utils.parse_filenames(["/data/" + f for f in filebases] + ["notes.txt"])
+
+    assert list(df.index) == filebases
+    assert unparsed == ["notes.txt"]
+
+    for filebase in filebases:
+        parsed = utils.parse(filebase)
+        for field in ["filetype", "barcode", "cloneid", "treatment", "replicate", "rig"]:
+            assert df.loc[filebase, field] == parsed[field]
+        assert df.loc[filebase, "datetime"].strftime("%Y%m%dT%H%M%S") == parsed["datetime"]
+
+def test_parse_filenames_empty():
+
+    df, unparsed = utils.parse_filenames([])
+
+    assert len(df) == 0
+    assert list(df.columns) == utils.FILENAME_FIELDS
+    assert unparsed == []